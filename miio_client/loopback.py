@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+# Loopback harness for a host build of miio_client: plays the lumi daemon on
+# the local TCP port (54322) and two remote clients on the UDP port (54321).
+#
+#   gcc -std=c99 -o /tmp/miio_client miio_client.c lib/cJSON/cJSON.c
+#   python3 loopback.py /tmp/miio_client [--batch 50]
+#
+# With --batch, miio_client is started with -b and events are expected
+# newline separated in datagrams of at most 1480 bytes.
+#
+# Exits with the number of failed checks.
+
+import sys
+import json
+import time
+import socket
+import subprocess
+
+GATEWAY = ('127.0.0.1', 54321)
+LOCAL = ('127.0.0.1', 54322)
+
+
+class Lumi:
+
+    # Local TCP client: sends raw bytes, reads back the JSON frames
+    # miio_client forwards to it (requests and acks)
+
+    def __init__(self):
+        self.socket = socket.create_connection(LOCAL)
+        self.socket.settimeout(0.3)
+        self.pending = ''
+        self.decoder = json.JSONDecoder()
+
+    def send(self, *chunks):
+        for chunk in chunks:
+            self.socket.sendall(chunk)
+            time.sleep(0.05)
+
+    def frames(self):
+        try:
+            while True:
+                data = self.socket.recv(65536)
+                if not data:
+                    break
+                self.pending = self.pending + data.decode()
+        except socket.timeout:
+            pass
+        frames = []
+        text = self.pending.replace('\0', ' ')
+        pos = 0
+        while pos < len(text):
+            if text[pos] == ' ':
+                pos = pos + 1
+                continue
+            frame, pos = self.decoder.raw_decode(text, pos)
+            frames.append(frame)
+        self.pending = ''
+        return frames
+
+
+class Remote:
+
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.settimeout(0.3)
+
+    def send(self, message):
+        self.socket.sendto(json.dumps(message).encode(), GATEWAY)
+
+    def received(self):
+        datagrams = []
+        try:
+            while True:
+                datagrams.append(self.socket.recv(65536))
+        except socket.timeout:
+            return datagrams
+
+
+failures = 0
+
+
+def check(name, condition):
+    global failures
+    print(("PASS " if condition else "FAIL ") + name)
+    if not condition:
+        failures = failures + 1
+
+
+def event(sid, size=0):
+    return {
+        "id": 12345,
+        "method": "props",
+        "sid": sid,
+        "model": "sensor_ht.v1",
+        "params": {"temperature": 2150, "padding": "x" * size},
+    }
+
+
+def main(argv):
+    command = [argv[0]]
+    batch = '--batch' in argv
+    if batch:
+        command = command + ['-b', argv[argv.index('--batch') + 1]]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    time.sleep(0.3)
+    try:
+        run(batch)
+    finally:
+        process.terminate()
+        process.wait()
+    return failures
+
+
+def run(batch):
+    lumi = Lumi()
+    a = Remote()
+    b = Remote()
+
+    b.socket.sendto(b'{"method": "internal.PING"}', GATEWAY)
+    pong = b.received()
+    check("PING answered", len(pong) == 1 and b'internal.PONG' in pong[0])
+
+    a.send({"id": 1, "method": "get_arming"})
+    forwarded = lumi.frames()
+    check(
+        "request forwarded to the local client",
+        {"id": 1, "method": "get_arming"} in forwarded
+    )
+
+    reply = b'{"id": 1, "result": ["off"]}'
+    lumi.send(reply[:5], reply[5:17], reply[17:])
+    got = a.received()
+    check("reply read in pieces is one datagram", got == [reply])
+    check("reply not sent to other clients", b.received() == [])
+
+    frames = [
+        json.dumps(event("lumi.%d" % i)).encode() for i in range(3)
+    ]
+    lumi.send(frames[0] + b'\0' + frames[1] + b'\n' + frames[2])
+    got_a = a.received()
+    got_b = b.received()
+    if batch:
+        frames = [b'\n'.join(frames)]
+    check("glued events split", got_a == frames)
+    check("events sent to every subscriber", got_b == frames)
+
+    if batch:
+        frames = [
+            json.dumps(event("lumi.%d" % i, 60)).encode() for i in range(40)
+        ]
+        lumi.send(b''.join(frames))
+        got = a.received()
+        b.received()
+        check(
+            "batches split at 1480 bytes",
+            max(len(datagram) for datagram in got) <= 1480 and
+            b'\n'.join(got).split(b'\n') == frames
+        )
+        a.send({"id": 2, "method": "get_arming"})
+        lumi.frames()
+        reply = b'{"id": 2, "result": ["off"]}'
+        lumi.send(json.dumps(event("lumi.pending")).encode() + reply)
+        got = a.received()
+        b.received()
+        check("replies not held by a batch", got[:1] == [reply])
+
+    large = json.dumps(event("lumi.big", 3000)).encode()
+    lumi.send(large[:1000], large[1000:2000], large[2000:])
+    got = a.received()
+    check("3 KB frame not truncated", got == [large])
+    b.received()
+
+    tricky = json.dumps({
+        "id": 12345, "method": "props", "sid": "lumi.s",
+        "params": {"name": "a } \" { b"}
+    }).encode()
+    lumi.send(tricky)
+    check("braces and quotes in strings", a.received() == [tricky])
+    b.received()
+
+    huge = json.dumps(event("lumi.huge", 10000)).encode()
+    after = json.dumps(event("lumi.after")).encode()
+    lumi.send(huge, after)
+    got = a.received()
+    check("frame after an oversized one", got[-1:] == [after])
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
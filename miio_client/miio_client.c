@@ -23,6 +23,9 @@
  * THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
  */
 
+// clock_gettime with -std=c99
+#define _POSIX_C_SOURCE 200809L
+
 #include <arpa/inet.h>
 #include <errno.h>
 #include <fcntl.h>
@@ -33,7 +36,7 @@
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
-#include <sys/select.h>
+#include <sys/epoll.h>
 #include <sys/socket.h>
 #include <sys/types.h>
 #include <time.h>
@@ -45,28 +48,84 @@
 #define COUNT_OF(x)                                                            \
   ((sizeof(x) / sizeof(0 [x])) / ((size_t)(!(sizeof(x) % sizeof(0 [x])))))
 
-int main(void);
+struct stream;
+
+int main(int argc, char *argv[]);
 void accept_local_server(void);
+void add_request(int id, const struct sockaddr_in *address);
+void add_subscriber(const struct sockaddr_in *address);
 void exit_programm(void);
+void flush_batch(void);
 void print_bin_array(unsigned char *var, size_t length);
 void process_global_message(void);
+void process_internal_client(void);
 void process_local_client(size_t client_socket_idx);
+bool process_local_frame(size_t client_socket_idx, unsigned char *payload_loc,
+                         size_t payload_size);
 int read_internal_info(cJSON *payload_json);
 int read_local(int client, cJSON *payload_json);
 int read_token(cJSON *payload_json);
 int read_device_id(cJSON *payload_json);
 int request_device_id(void);
 int request_token(void);
+bool same_address(const struct sockaddr_in *a, const struct sockaddr_in *b);
+void send_event(const unsigned char *data, size_t length);
+void send_to_subscribers(const unsigned char *data, size_t length);
 void setup_server_sockets(void);
 void signalhandler(int signum);
+bool take_request(int id, struct sockaddr_in *address);
+void stream_consume(struct stream *stream, size_t length);
+size_t stream_frame(struct stream *stream);
+ssize_t stream_read(int socket, struct stream *stream);
+void stream_reset(struct stream *stream);
+time_t uptime(void);
+long long uptime_ms(void);
+void unwatch_socket(int socket);
+void watch_socket(int socket);
+
+// largest JSON frame a local client may send
+#define STREAM_SIZE 8192
+
+// bytes received from a local client until they make complete JSON frames:
+// a frame starts at data[0] and ends on the brace closing its first one
+struct stream {
+  unsigned char data[STREAM_SIZE + 1]; // + the NUL terminating a frame
+  size_t length;                       // bytes held
+  size_t scanned;                      // bytes scanned for the frame end
+  int depth;                           // brace depth at scanned
+  bool in_string;
+  bool escaped;
+};
 
-// save the last ids and addresses in a map
-struct socketaddr_map_item {
+// seconds a request id waits for its reply
+#define REQUEST_TTL 10
+// seconds a remote client stays subscribed to events after its last datagram
+#define SUBSCRIBER_TTL 600
+// epoll events handled per wakeup
+#define MAX_EVENTS 16
+// largest batch of events sent in one datagram
+#define MIIO_LEN_MAX 1480
+
+// requests of the remote clients waiting for their reply, by id
+struct request_map_item {
   int id;
+  time_t expires; // 0: free
+  struct sockaddr_in address;
+};
+struct request_map_item request_map[64];
+
+// remote clients receiving the events, each address once
+struct subscriber_item {
+  time_t expires; // 0: free
   struct sockaddr_in address;
 };
-struct socketaddr_map_item socketaddr_map[10];
-size_t socketaddr_map_newest_item = 0;
+struct subscriber_item subscribers[8];
+
+// events waiting to be sent together, newline separated (-b milliseconds)
+static int batch_window_ms = 0; // 0: one datagram per event
+static unsigned char batch[MIIO_LEN_MAX];
+static size_t batch_length = 0;
+static long long batch_deadline = 0;
 
 // todo use real token an device id
 static unsigned char robot_token[16] = {0x7f, 0x7f, 0x7f, 0x7f, 0x7f, 0x7f,
@@ -80,15 +139,29 @@ static bool robot_device_id_valid = false;
 static int local_server_socket;
 static int global_server_socket;
 static int local_client_sockets[10];
+static struct stream local_client_streams[10];
 static size_t local_client_sockets_in_use = 0;
 static int local_client_socket_internal = -1;
+static struct stream internal_stream;
 
 // local pipe file handler
 static int pipefd[2];
 
+static int epoll_fd;
+
 unsigned char buffer[1024];
 
-int main(void) {
+int main(int argc, char *argv[]) {
+  int option;
+  while ((option = getopt(argc, argv, "b:")) != -1) {
+    if (option == 'b') {
+      batch_window_ms = atoi(optarg);
+    } else {
+      fprintf(stderr, "Usage: %s [-b batch_window_ms]\n", argv[0]);
+      return EXIT_FAILURE;
+    }
+  }
+
   // signal handler for sigint
   signal(SIGINT, signalhandler);
   signal(SIGTERM, signalhandler);
@@ -106,8 +179,18 @@ int main(void) {
     local_client_sockets[i] = -1;
   }
 
+  epoll_fd = epoll_create1(0);
+  if (epoll_fd == -1) {
+    perror("Couldn't create epoll instance");
+    exit_programm();
+  }
+  watch_socket(pipefd[0]);
+  watch_socket(local_server_socket);
+  watch_socket(global_server_socket);
+
   // handle acitivity
-  while (1) {
+  bool running = true;
+  while (running) {
     if (!robot_device_id_valid && local_client_socket_internal > -1) {
       printf("Requesting device id.\n");
       request_device_id();
@@ -116,80 +199,264 @@ int main(void) {
       // request_token();
     }
 
-    // file discriptor set for the sockets and the pipe
-    fd_set readfds;
-
-    // highest-numbered file descriptor
-    int maxfd = local_server_socket;
-    if (global_server_socket > maxfd) {
-      maxfd = local_server_socket;
+    // wait for activity, or until the pending batch is due
+    int timeout = -1;
+    if (batch_length > 0) {
+      long long left = batch_deadline - uptime_ms();
+      timeout = left > 0 ? (int)left : 0;
     }
-    if (local_client_socket_internal > maxfd) {
-      maxfd = local_client_socket_internal;
+    struct epoll_event events[MAX_EVENTS];
+    int count = epoll_wait(epoll_fd, events, MAX_EVENTS, timeout);
+    if (count == -1) {
+      if (errno == EINTR) {
+        continue;
+      }
+      perror("Couldn't wait for activity");
+      break;
     }
-    if (pipefd[0] > maxfd) {
-      maxfd = pipefd[0];
+    if (batch_length > 0 && uptime_ms() >= batch_deadline) {
+      flush_batch();
     }
-
-    // reset the file discriptor set and add file discriptors
-    FD_ZERO(&readfds);
-    FD_SET(pipefd[0], &readfds);
-    FD_SET(local_server_socket, &readfds);
-    FD_SET(global_server_socket, &readfds);
-    FD_SET(local_client_socket_internal, &readfds);
-    for (size_t i = 0; i < COUNT_OF(local_client_sockets); i++) {
-      int client_socket = local_client_sockets[i];
-      if (client_socket >= 0) {
-        FD_SET(client_socket, &readfds);
+    for (int e = 0; e < count; e++) {
+      int fd = events[e].data.fd;
+      if (fd == pipefd[0]) {
+        // self pipe handler was called (signal received)
+        running = false;
+        break;
       }
-      // update heighest file discriptor
-      if (client_socket > maxfd) {
-        maxfd = client_socket;
+      if (fd == local_server_socket) {
+        accept_local_server();
+      } else if (fd == global_server_socket) {
+        process_global_message();
+      } else if (fd == local_client_socket_internal) {
+        process_internal_client();
+      } else {
+        for (size_t i = 0; i < COUNT_OF(local_client_sockets); i++) {
+          if (local_client_sockets[i] == fd) {
+            // activity on client socket
+            process_local_client(i);
+            break;
+          }
+        }
       }
     }
+  }
 
-    // wait for activity
-    select(maxfd + 1, &readfds, NULL, NULL, NULL);
-    if (FD_ISSET(pipefd[0], &readfds)) {
-      // self pipe handler was called (signal received)
-      break;
+  exit_programm();
+}
+
+void process_internal_client(void) {
+  ssize_t ret = stream_read(local_client_socket_internal, &internal_stream);
+  if (ret < 0) {
+    perror("Couldn't read client socket");
+    unwatch_socket(local_client_socket_internal);
+    close(local_client_socket_internal);
+    local_client_socket_internal = -1;
+  } else if (ret == 0) {
+    // client disconnected
+    printf("local client internal disconnected.\n");
+    unwatch_socket(local_client_socket_internal);
+    close(local_client_socket_internal);
+    local_client_socket_internal = -1;
+  } else {
+    // ignore
+    size_t frame_length;
+    while ((frame_length = stream_frame(&internal_stream)) > 0) {
+      internal_stream.data[frame_length] = '\0';
+      printf("Ingoring message from internal:\n");
+      printf("%s\n", internal_stream.data);
+      stream_consume(&internal_stream, frame_length);
     }
-    if (FD_ISSET(local_server_socket, &readfds)) {
-      accept_local_server();
+  }
+}
+
+void stream_reset(struct stream *stream) {
+  stream->length = 0;
+  stream->scanned = 0;
+  stream->depth = 0;
+  stream->in_string = false;
+  stream->escaped = false;
+}
+
+ssize_t stream_read(int socket, struct stream *stream) {
+  if (stream->length == STREAM_SIZE) {
+    fprintf(stderr, "Frame larger than %d bytes dropped\n", STREAM_SIZE);
+    stream_reset(stream);
+  }
+  ssize_t ret = read(socket, stream->data + stream->length,
+                     STREAM_SIZE - stream->length);
+  if (ret > 0) {
+    stream->length += ret;
+  }
+  return ret;
+}
+
+size_t stream_frame(struct stream *stream) {
+  // length of the complete frame at the start of the stream, 0 if none yet
+  if (stream->scanned == 0) {
+    // drop what comes before a frame: NUL padding, whitespace, garbage
+    size_t skip = 0;
+    while (skip < stream->length && stream->data[skip] != '{') {
+      skip++;
     }
-    if (FD_ISSET(global_server_socket, &readfds)) {
-      process_global_message();
+    if (skip > 0) {
+      memmove(stream->data, stream->data + skip, stream->length - skip);
+      stream->length -= skip;
     }
-    if (FD_ISSET(local_client_socket_internal, &readfds)) {
-      ssize_t ret =
-          read(local_client_socket_internal, buffer, sizeof(buffer) - 1);
-      if (ret < 0) {
-        perror("Couldn't read client socket");
-        close(local_client_socket_internal);
-        local_client_socket_internal = -1;
-      } else if (ret == 0) {
-        // client disconnected
-        printf("local client internal disconnected.\n");
-        close(local_client_socket_internal);
-        local_client_socket_internal = -1;
-      } else {
-        // ignore
-        if (buffer[ret - 1] != '\0') {
-          buffer[ret] = '\0';
-        }
-        printf("Ingoring message from internal:\n");
-        printf("%s\n", buffer);
+  }
+  // only bytes not scanned yet, a frame read in pieces is scanned once
+  for (size_t i = stream->scanned; i < stream->length; i++) {
+    unsigned char c = stream->data[i];
+    if (stream->in_string) {
+      if (stream->escaped) {
+        stream->escaped = false;
+      } else if (c == '\\') {
+        stream->escaped = true;
+      } else if (c == '"') {
+        stream->in_string = false;
+      }
+    } else if (c == '"') {
+      stream->in_string = true;
+    } else if (c == '{') {
+      stream->depth++;
+    } else if (c == '}') {
+      stream->depth--;
+      if (stream->depth == 0) {
+        stream->scanned = i + 1;
+        return i + 1;
       }
     }
-    for (size_t i = 0; i < COUNT_OF(local_client_sockets); i++) {
-      if (FD_ISSET(local_client_sockets[i], &readfds)) {
-        // activity on client socket
-        process_local_client(i);
+  }
+  stream->scanned = stream->length;
+  return 0;
+}
+
+void stream_consume(struct stream *stream, size_t length) {
+  size_t rest = stream->length - length;
+  memmove(stream->data, stream->data + length, rest);
+  stream_reset(stream);
+  stream->length = rest;
+}
+
+void watch_socket(int socket) {
+  struct epoll_event event = {.events = EPOLLIN, .data.fd = socket};
+  if (epoll_ctl(epoll_fd, EPOLL_CTL_ADD, socket, &event) == -1) {
+    perror("Couldn't watch socket");
+  }
+}
+
+void unwatch_socket(int socket) {
+  if (epoll_ctl(epoll_fd, EPOLL_CTL_DEL, socket, NULL) == -1) {
+    perror("Couldn't unwatch socket");
+  }
+}
+
+time_t uptime(void) {
+  struct timespec now;
+  clock_gettime(CLOCK_MONOTONIC, &now);
+  return now.tv_sec;
+}
+
+long long uptime_ms(void) {
+  struct timespec now;
+  clock_gettime(CLOCK_MONOTONIC, &now);
+  return (long long)now.tv_sec * 1000 + now.tv_nsec / 1000000;
+}
+
+bool same_address(const struct sockaddr_in *a, const struct sockaddr_in *b) {
+  return a->sin_addr.s_addr == b->sin_addr.s_addr &&
+         a->sin_port == b->sin_port;
+}
+
+void add_subscriber(const struct sockaddr_in *address) {
+  // renew the address, or take a free, expired or the oldest entry
+  time_t now = uptime();
+  size_t slot = 0;
+  for (size_t i = 0; i < COUNT_OF(subscribers); i++) {
+    if (subscribers[i].expires != 0 &&
+        same_address(&subscribers[i].address, address)) {
+      slot = i;
+      break;
+    }
+    if (subscribers[i].expires < subscribers[slot].expires) {
+      slot = i;
+    }
+  }
+  if (subscribers[slot].expires <= now) {
+    printf("Subscriber added: %s:%d\n", inet_ntoa(address->sin_addr),
+           ntohs(address->sin_port));
+  }
+  subscribers[slot].expires = now + SUBSCRIBER_TTL;
+  subscribers[slot].address = *address;
+}
+
+void send_to_subscribers(const unsigned char *data, size_t length) {
+  time_t now = uptime();
+  for (size_t i = 0; i < COUNT_OF(subscribers); i++) {
+    if (subscribers[i].expires > now) {
+      if (sendto(global_server_socket, data, length, 0,
+                 (struct sockaddr *)&subscribers[i].address,
+                 sizeof(struct sockaddr)) == -1) {
+        perror("Couldn't forward local client package");
       }
     }
   }
+}
 
-  exit_programm();
+void send_event(const unsigned char *data, size_t length) {
+  if (batch_window_ms == 0 || length >= MIIO_LEN_MAX) {
+    // keep the order: what is batched goes first
+    flush_batch();
+    send_to_subscribers(data, length);
+    return;
+  }
+  if (batch_length > 0 && batch_length + 1 + length > MIIO_LEN_MAX) {
+    flush_batch();
+  }
+  if (batch_length == 0) {
+    batch_deadline = uptime_ms() + batch_window_ms;
+  } else {
+    batch[batch_length++] = '\n';
+  }
+  memcpy(batch + batch_length, data, length);
+  batch_length += length;
+}
+
+void flush_batch(void) {
+  if (batch_length > 0) {
+    send_to_subscribers(batch, batch_length);
+    batch_length = 0;
+  }
+}
+
+void add_request(int id, const struct sockaddr_in *address) {
+  // a retry reuses its entry, else take a free, expired or the oldest one
+  size_t slot = 0;
+  for (size_t i = 0; i < COUNT_OF(request_map); i++) {
+    if (request_map[i].expires != 0 && request_map[i].id == id &&
+        same_address(&request_map[i].address, address)) {
+      slot = i;
+      break;
+    }
+    if (request_map[i].expires < request_map[slot].expires) {
+      slot = i;
+    }
+  }
+  request_map[slot].id = id;
+  request_map[slot].expires = uptime() + REQUEST_TTL;
+  request_map[slot].address = *address;
+}
+
+bool take_request(int id, struct sockaddr_in *address) {
+  time_t now = uptime();
+  for (size_t i = 0; i < COUNT_OF(request_map); i++) {
+    if (request_map[i].expires > now && request_map[i].id == id) {
+      *address = request_map[i].address;
+      request_map[i].expires = 0;
+      return true;
+    }
+  }
+  return false;
 }
 
 void accept_local_server(void) {
@@ -209,6 +476,7 @@ void accept_local_server(void) {
       if (local_client_sockets[i] == -1) {
         local_client_sockets[i] = new_socket;
         local_client_sockets_in_use++;
+        watch_socket(new_socket);
         printf("Local client connected\n");
         break;
       }
@@ -225,6 +493,7 @@ void accept_local_server(void) {
 void exit_programm(void) {
   printf("Closing all sockets.\n");
 
+  close(epoll_fd);
   close(local_server_socket);
   close(global_server_socket);
   for (size_t i = 0; i < COUNT_OF(local_client_sockets); i++) {
@@ -378,21 +647,14 @@ void process_global_message(void) {
   struct sockaddr_in addr;
 
   socklen_t sockaddr_in_size = sizeof(struct sockaddr_in);
-  ssize_t length = recvfrom(global_server_socket, buffer, sizeof(buffer), 0,
-                            (struct sockaddr *)&addr, &sockaddr_in_size);
+  ssize_t length = recvfrom(global_server_socket, buffer, sizeof(buffer) - 1,
+                            0, (struct sockaddr *)&addr, &sockaddr_in_size);
   if (length < 0) {
     perror("Couldn't receive from socket");
     return;
   }
-    // add address to map
-    if (socketaddr_map_newest_item == 0) {
-      socketaddr_map_newest_item = COUNT_OF(socketaddr_map) - 1;
-    } else {
-      socketaddr_map_newest_item--;
-    }
-    // RothM socketaddr_map[socketaddr_map_newest_item].id = payload_id;
-    socketaddr_map[socketaddr_map_newest_item].id = 0;
-    socketaddr_map[socketaddr_map_newest_item].address = addr;
+    // any datagram (re)subscribes its sender to the events
+    add_subscriber(&addr);
 
     if(length>3 && strncmp((char *)buffer,"{\"method\": \"internal.PING\"}",27)==0)
     {
@@ -402,45 +664,71 @@ void process_global_message(void) {
     }
     else
     {
+	    // remember who is waiting for the reply to this id
+	    buffer[length] = '\0';
+	    cJSON *payload_json = cJSON_Parse((char *)buffer);
+	    if (payload_json != NULL) {
+	      cJSON *id = cJSON_GetObjectItemCaseSensitive(payload_json, "id");
+	      if (cJSON_IsNumber(id)) {
+	        add_request(id->valueint, &addr);
+	      }
+	      cJSON_Delete(payload_json);
+	    }
 	    // send to all local clients
 	    for (size_t i = 0; i < COUNT_OF(local_client_sockets); i++) {
 	      int client_socket = local_client_sockets[i];
 	      if (client_socket > 0) {
-// RothM        if (send(client_socket, payload_loc, payload_size, 0) == -1) {
 	        if (send(client_socket, buffer, length, 0) == -1) {
 	        }
 	      }
 	    }
     }
-// RothM  }
 }
 
 void process_local_client(size_t client_socket_idx) {
-  char ackmsg[1024];
   int client_socket = local_client_sockets[client_socket_idx];
-  unsigned char *payload_loc = &buffer[0x20];
-  ssize_t payload_size = sizeof(buffer) - 0x20;
-  payload_size = read(client_socket, payload_loc, payload_size - 1);
-  if (payload_size < 0) {
+  struct stream *stream = &local_client_streams[client_socket_idx];
+  ssize_t ret = stream_read(client_socket, stream);
+  if (ret < 0) {
     perror("Couldn't read client socket");
+    unwatch_socket(client_socket);
     close(client_socket);
     local_client_sockets[client_socket_idx] = -1;
     local_client_sockets_in_use--;
     return;
-  } else if (payload_size == 0) {
+  } else if (ret == 0) {
     // client disconnected
     printf("Local client disconnected.\n");
+    unwatch_socket(client_socket);
     close(client_socket);
     local_client_sockets[client_socket_idx] = -1;
     local_client_sockets_in_use--;
     return;
   }
 
-  // ensure zero padding
-  if (payload_loc[payload_size] != '\0') {
-    payload_loc[payload_size] = '\0';
-    payload_size++;
+  // one read may hold several frames, or only part of one
+  size_t frame_length;
+  while ((frame_length = stream_frame(stream)) > 0) {
+    unsigned char next = stream->data[frame_length];
+    stream->data[frame_length] = '\0';
+    bool local = process_local_frame(client_socket_idx, stream->data,
+                                     frame_length);
+    stream->data[frame_length] = next;
+    stream_consume(stream, frame_length);
+    if (!local) {
+      // became the internal client, with what it sent after the hello
+      internal_stream = *stream;
+      stream_reset(stream);
+      return;
+    }
   }
+}
+
+bool process_local_frame(size_t client_socket_idx, unsigned char *payload_loc,
+                         size_t payload_size) {
+  // payload_loc holds one JSON object, NUL terminated
+  char ackmsg[1024];
+  int client_socket = local_client_sockets[client_socket_idx];
 
   printf("Received from local client:\n");
   printf("%s\n", payload_loc);
@@ -449,7 +737,7 @@ void process_local_client(size_t client_socket_idx) {
   cJSON *payload_json = cJSON_Parse((char *)payload_loc);
   if (payload_json == NULL) {
     fprintf(stderr, "JSON parse error\n");
-    return;
+    return true;
   }
   cJSON *method = cJSON_GetObjectItemCaseSensitive(payload_json, "method");
 
@@ -461,7 +749,8 @@ void process_local_client(size_t client_socket_idx) {
       local_client_socket_internal = client_socket;
       local_client_sockets[client_socket_idx] = -1;
       local_client_sockets_in_use--;
-      return;
+      cJSON_Delete(payload_json);
+      return false;
     }
   }
   if (cJSON_IsString(method) && (method->valuestring != NULL)) {
@@ -471,18 +760,21 @@ void process_local_client(size_t client_socket_idx) {
       if (read_internal_info(payload_json) != 0) {
         fprintf(stderr, "Error reading _internal message!\n");
       }
-      return;
+      cJSON_Delete(payload_json);
+      return true;
     }
   }
   cJSON *id = cJSON_GetObjectItemCaseSensitive(payload_json, "id");
   if (!cJSON_IsNumber(id)) {
     fprintf(stderr, "Invalid payload id.\n");
-    return;
+    cJSON_Delete(payload_json);
+    return true;
   }
   int payload_id = id->valueint;
   if (payload_id < 0) {
     fprintf(stderr, "Payload id is negative.\n");
-    return;
+    cJSON_Delete(payload_json);
+    return true;
   }
   
   if (cJSON_IsString(method) && (method->valuestring != NULL)) {
@@ -492,10 +784,15 @@ void process_local_client(size_t client_socket_idx) {
       if (read_local(client_socket, payload_json) != 0) {
         fprintf(stderr, "Error reading local message!\n");
       }
-      return;
+      cJSON_Delete(payload_json);
+      return true;
     }
   }
 
+  // replies go back to the requester only, everything else is an event
+  bool is_reply =
+      cJSON_GetObjectItemCaseSensitive(payload_json, "result") != NULL ||
+      cJSON_GetObjectItemCaseSensitive(payload_json, "error") != NULL;
   cJSON_Delete(payload_json);
 
 // RothM
@@ -509,20 +806,16 @@ void process_local_client(size_t client_socket_idx) {
   }
 
 
-  // send to newest client with matching id
-  size_t socketaddr_map_oldest_item =
-      (socketaddr_map_newest_item + 1) % COUNT_OF(socketaddr_map);
-  for (size_t i = socketaddr_map_newest_item; i != socketaddr_map_oldest_item;
-       i = (i + 1) % COUNT_OF(socketaddr_map)) {
-// RothM    if (socketaddr_map[i].id == payload_id) {
-// RothM      if (sendto(global_server_socket, buffer, packet_size, 0,
-      if (sendto(global_server_socket, payload_loc, payload_size, 0,
-                 (struct sockaddr *)&socketaddr_map[i].address,
-                 sizeof(struct sockaddr)) == -1) {
-        perror("Couldn't forward local client package");
-      }
-//    }
+  struct sockaddr_in requester;
+  if (is_reply && take_request(payload_id, &requester)) {
+    if (sendto(global_server_socket, payload_loc, payload_size, 0,
+               (struct sockaddr *)&requester, sizeof(struct sockaddr)) == -1) {
+      perror("Couldn't forward local client package");
+    }
+  } else {
+    send_event(payload_loc, payload_size);
   }
+  return true;
 }
 
 void setup_server_sockets(void) {
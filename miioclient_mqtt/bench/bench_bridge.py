@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+# End to end benchmark of the bridge without hardware: the real Gateway and
+# MQTT callbacks of miioclient_mqtt.py, driven by FakeMqtt and talking UDP
+# to a FakeGateway running in a child process.
+#
+#   python3 bench/bench_bridge.py [--duration 10] [--command-rate 50]
+#       [--event-rate 200] [--latency 0.01] [--loss 0.0] [--window 4]
+#       [--record file]
+#
+# Reports command round trip (MQTT message in -> gateway reply handled),
+# events and publishes per second, CPU per event and queue depth.
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import threading
+import multiprocessing
+
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+)
+import miioclient_mqtt as bridge  # noqa: E402
+from bench import fake_gateway  # noqa: E402
+from bench.fake_mqtt import FakeMqtt  # noqa: E402
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Probe:
+
+    # Hooks timing and counters onto a running Gateway
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self.injected = {}
+        self.rtts = []
+        self.sent = 0
+        self.timeouts = 0
+        self.events = 0
+        self.depths = []
+        self.inflight = []
+        request = gateway.miio.request
+        handle_msg = gateway.miio.handle_msg
+
+        def timed_request(req, states, window=True):
+            future = request(req, states, window)
+            if req[1].get('method') == 'set_gateway_volume':
+                self.sent = self.sent + 1
+                started = self.injected.pop(req[1]['params'][0], None)
+                if started is not None:
+                    future.add_done_callback(
+                        lambda done: self.replied(done, started)
+                    )
+            return future
+
+        def counted_handle_msg(miio_msg, states):
+            self.events = self.events + 1
+            return handle_msg(miio_msg, states)
+
+        gateway.miio.request = timed_request
+        gateway.miio.handle_msg = counted_handle_msg
+
+    def replied(self, future, started):
+        if future.result() is None:
+            self.timeouts = self.timeouts + 1
+        else:
+            self.rtts.append(time.monotonic() - started)
+
+    def sample(self, loop, interval):
+        self.depths.append(self.gateway.queue.qsize())
+        self.inflight.append(len(self.gateway.miio.pending))
+        loop.call_later(interval, self.sample, loop, interval)
+
+
+def inject(mqtt, probe, rate, duration):
+    # Plays the paho network thread: one sound/volume command every 1/rate s
+    value = 0
+    start = time.monotonic()
+    while time.monotonic() - start < duration:
+        value = value + 1
+        probe.injected[value] = time.monotonic()
+        mqtt.inject('sound/volume', str(value))
+        time.sleep(1 / rate)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Bridge benchmark")
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--command-rate', type=float, default=50)
+    parser.add_argument('--event-rate', type=float, default=200)
+    parser.add_argument('--latency', type=float, default=0.01)
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--window', type=int, default=4)
+    parser.add_argument('--capacity', type=float, default=0,
+                        help="requests the fake gateway serves per second")
+    parser.add_argument('--no-rate', action='store_true',
+                        help="send without the adaptive rate limiter")
+    parser.add_argument('--port', type=int, default=54399)
+    parser.add_argument('--record', help="record the traffic to this file")
+    args = parser.parse_args(argv)
+
+    gateway_process = multiprocessing.Process(
+        target=fake_gateway.run,
+        args=('127.0.0.1', args.port, args.latency, args.loss,
+              args.event_rate, 50, args.capacity),
+        daemon=True
+    )
+    gateway_process.start()
+    time.sleep(0.5)
+
+    config = {
+        'mqtt': {'prefix': '/bench/', 'broker': None, 'resync': 0},
+        'miio': {
+            'broker': '127.0.0.1',
+            'port': args.port,
+            'window': args.window,
+            'record': args.record,
+            'rate': False if args.no_rate else {}
+        },
+        'silent_start': True,
+    }
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    mqtt = FakeMqtt()
+    mqtt.set_prefix(config['mqtt']['prefix'])
+    mqtt.on_connect = bridge.mqtt_connect
+    mqtt.on_message = bridge.mqtt_message
+    gateways = bridge.gateways_init(config, mqtt, loop)
+    mqtt.loop_start()
+    bridge.gateways_start(gateways, loop)
+    probe = Probe(gateways[0])
+    loop.call_soon(probe.sample, loop, 0.05)
+
+    # Let the init sequence go through before measuring
+    loop.run_until_complete(asyncio.sleep(1))
+    events = probe.events
+    publishes = mqtt.publishes
+    cpu = time.process_time()
+    injector = threading.Thread(
+        target=inject,
+        args=(mqtt, probe, args.command_rate, args.duration),
+        daemon=True
+    )
+    injector.start()
+    loop.run_until_complete(asyncio.sleep(args.duration))
+    injector.join()
+    # Give the last commands time to be answered
+    loop.run_until_complete(asyncio.sleep(2 * args.latency + 0.5))
+    cpu = time.process_time() - cpu
+    events = probe.events - events
+    publishes = mqtt.publishes - publishes
+    gateway_process.terminate()
+    for gateway in gateways:
+        gateway.close()
+
+    injected = int(args.command_rate * args.duration)
+    print("commands injected    ~%d, sent %d, timeouts %d" % (
+        injected, probe.sent, probe.timeouts
+    ))
+    print("command rtt          p50 %.2f ms, p99 %.2f ms" % (
+        percentile(probe.rtts, 0.5) * 1000,
+        percentile(probe.rtts, 0.99) * 1000
+    ))
+    print("events handled       %.1f /s" % (events / args.duration))
+    print("publishes            %.1f /s" % (publishes / args.duration))
+    print("cpu per event        %.1f us (%.1f%% of one core)" % (
+        cpu / max(1, events + probe.sent) * 1e6,
+        cpu / args.duration * 100
+    ))
+    print("queue depth          avg %.2f, max %d" % (
+        sum(probe.depths) / max(1, len(probe.depths)), max(probe.depths)
+    ))
+    print("in flight            avg %.2f, max %d" % (
+        sum(probe.inflight) / max(1, len(probe.inflight)),
+        max(probe.inflight)
+    ))
+    limiter = gateways[0].miio.limiter
+    if limiter is not None:
+        print("send rate            %.1f /s, %d cuts" % (
+            limiter.rate, limiter.cuts
+        ))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+# Micro-benchmark of Miio.msg_decode against the former '}{' replace hack
+# on datagrams carrying several JSON objects. The recovery of the good
+# frames around bad ones is checked first.
+#
+#   python3 bench/bench_decode.py [iterations]
+
+import os
+import sys
+import json
+import asyncio
+import logging
+import timeit
+
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+)
+from classes.Miio import Miio  # noqa: E402
+
+
+# datagram -> frames msg_decode must still yield
+RECOVERY = [
+    (b'abc{"id":5,"result":["ok"]}', [{"id": 5, "result": ["ok"]}]),
+    (b'garbage{"a":1}{"b":2}', [{"a": 1}, {"b": 2}]),
+    (b'{"a":1,}{"b":2}', [{"b": 2}]),
+    (b'{"a":"}{"}x{"b":2}', [{"a": "}{"}, {"b": 2}]),
+    (b'{"a":1}\n{"b":[}\n{"c":3}', [{"a": 1}, {"c": 3}]),
+    (b'{"a":1}trailing', [{"a": 1}]),
+]
+
+
+def legacy_decode(data):
+    if data[-1] == 0:
+        data = data[:-1]
+    res = [{""}]
+    try:
+        fixed_str = data.decode().replace('}{', '},{')
+        res = json.loads("[" + fixed_str + "]")
+    except ValueError:
+        pass
+    return res
+
+
+def datagram(count):
+    frames = []
+    for i in range(count):
+        frames.append(json.dumps({
+            "sid": "lumi.158d000%d" % i,
+            "model": "sensor_ht.v1",
+            "method": "props",
+            "params": {"temperature": 2150 + i, "humidity": 4800 + i}
+        }, separators=(',', ':')))
+    return ''.join(frames).encode() + b'\x00'
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    miio = Miio(None)
+    logging.disable(logging.WARNING)
+    for data, frames in RECOVERY:
+        decoded = list(miio.msg_decode(data))
+        assert decoded == frames, (data, decoded)
+    logging.disable(logging.NOTSET)
+    print("%8s %14s %14s %8s" % (
+        "objects", "legacy us/dg", "stream us/dg", "ratio"
+    ))
+    for count in (1, 2, 4, 8, 16):
+        data = datagram(count)
+        assert legacy_decode(data) == list(miio.msg_decode(data))
+        legacy = min(timeit.repeat(
+            lambda: legacy_decode(data), number=iterations, repeat=3
+        )) / iterations * 1e6
+        stream = min(timeit.repeat(
+            lambda: list(miio.msg_decode(data)), number=iterations, repeat=3
+        )) / iterations * 1e6
+        print("%8d %14.2f %14.2f %8.2f" % (
+            count, legacy, stream, legacy / stream
+        ))
+
+
+if __name__ == '__main__':
+    main()
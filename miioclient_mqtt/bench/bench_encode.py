@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# Micro-benchmark of Miio.msg_encode (bytes templates) against the former
+# dict merge + json.dumps path, on the commands an effect sends per frame
+# and on a few others.
+#
+#   python3 bench/bench_encode.py [iterations]
+
+import os
+import sys
+import json
+import asyncio
+import timeit
+
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+)
+from classes.Miio import Miio  # noqa: E402
+from classes.MiioMsg import MiioMsg  # noqa: E402
+
+
+class LegacyMiio:
+
+    miio_id = 0
+
+    def msg_encode(self, data):
+        if data.get("method") and data.get("method") == "internal.PING":
+            msg = data
+        else:
+            if self.miio_id != 12345:
+                self.miio_id = self.miio_id + 1
+            else:
+                self.miio_id = self.miio_id + 2
+            if self.miio_id > 999999999:
+                self.miio_id = 1
+            msg = {"id": self.miio_id}
+            msg.update(data)
+        return (json.dumps(msg)).encode()
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    miio = Miio(None)
+    legacy = LegacyMiio()
+    commands = [
+        ("set_rgb", MiioMsg.set_rgb(54, 0xff00ff)),
+        ("toggle_light", MiioMsg.set_light('on')),
+        ("play_music_new", MiioMsg.play_sound(10, 20)),
+        ("set_device_prop", MiioMsg.set_alarm_duration(30)),
+        ("get_arming", MiioMsg.get_arming()),
+    ]
+    print("%16s %12s %12s %8s" % (
+        "command", "legacy us", "template us", "ratio"
+    ))
+    for name, req in commands:
+        data = req[1]
+        assert legacy.msg_encode(data) == miio.msg_encode(data)
+        legacy.miio_id = miio.miio_id = 0
+        before = min(timeit.repeat(
+            lambda: legacy.msg_encode(data), number=iterations, repeat=3
+        )) / iterations * 1e6
+        after = min(timeit.repeat(
+            lambda: miio.msg_encode(data), number=iterations, repeat=3
+        )) / iterations * 1e6
+        print("%16s %12.2f %12.2f %8.2f" % (
+            name, before, after, before / after
+        ))
+
+    # Extra keys must survive once the method's template is cached
+    for data in (
+        {"method": "set_rgb", "params": [1], "sid": "lumi.158d0001"},
+        {"method": "get_arming", "sid": "lumi.158d0001"},
+    ):
+        assert legacy.msg_encode(data) == miio.msg_encode(data), data
+
+    # An effect frame as the bridge produces it: build the command, encode
+    frame = min(timeit.repeat(
+        lambda: miio.msg_encode(MiioMsg.set_rgb(54, 0xff00ff)[1]),
+        number=iterations, repeat=3
+    )) / iterations
+    print("effect frame (build + encode) %.2f us, %d frames/s per core" % (
+        frame * 1e6, 1 / frame
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+# UDP stand-in for the modified miio_client running on the gateway.
+# Answers internal.PING and gateway commands with configurable latency and
+# loss, and can stream synthetic props / event.motion packets to the last
+# client that talked to it. With a capacity, requests are served one after
+# the other at that rate from a buffer of BUFFER requests, the ones
+# arriving when it is full are silently dropped, as the real gateway does.
+#
+#   python3 bench/fake_gateway.py [--port 54321] [--latency 0.01]
+#       [--loss 0.0] [--event-rate 0] [--devices 20] [--capacity 0]
+
+import sys
+import json
+import random
+import asyncio
+import argparse
+
+
+class FakeGateway(asyncio.DatagramProtocol):
+
+    BUFFER = 20
+
+    # Results of the query methods, everything else answers ["ok"]
+    RESULTS = {
+        'get_arming': ['off'],
+        'get_arm_wait_time': [30],
+        'get_gateway_volume': [50],
+        'get_alarming_volume': [90],
+        'get_doorbell_volume': [25],
+    }
+
+    def __init__(self, latency=0.01, loss=0.0, event_rate=0, devices=20,
+                 capacity=0):
+        self.latency = latency
+        self.loss = loss
+        self.capacity = capacity
+        self.busy_until = 0
+        self.event_rate = event_rate
+        self.devices = devices
+        self.transport = None
+        self.client = None
+        self.loop = asyncio.get_event_loop()
+        self.received = 0
+        self.dropped = 0
+        self.events = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.event_rate:
+            self.loop.call_later(1 / self.event_rate, self.emit)
+
+    def datagram_received(self, data, addr):
+        self.client = addr
+        self.received = self.received + 1
+        if random.random() < self.loss:
+            return
+        try:
+            request = json.loads(data.rstrip(b'\x00'))
+        except ValueError:
+            return
+        delay = self.latency * random.uniform(0.5, 1.5)
+        if self.capacity:
+            now = self.loop.time()
+            start = max(now, self.busy_until)
+            if (start - now) * self.capacity >= self.BUFFER:
+                self.dropped = self.dropped + 1
+                return
+            self.busy_until = start + 1 / self.capacity
+            delay = delay + self.busy_until - now
+        method = request.get('method')
+        if method == 'internal.PING':
+            reply = {"method": "internal.PONG", "result": ["online"]}
+        else:
+            reply = {
+                "id": request.get('id'),
+                "result": self.RESULTS.get(method, ['ok'])
+            }
+        self.loop.call_later(
+            delay,
+            self.transport.sendto,
+            json.dumps(reply).encode(),
+            addr
+        )
+
+    def emit(self):
+        self.loop.call_later(1 / self.event_rate, self.emit)
+        if self.client is None:
+            return
+        sid = "lumi.158d0000%04x" % random.randrange(self.devices)
+        if random.random() < 0.8:
+            packet = {
+                "sid": sid,
+                "model": "sensor_ht.v1",
+                "method": "props",
+                "params": {
+                    "temperature": random.randrange(1800, 2600),
+                    "humidity": random.randrange(3000, 7000)
+                }
+            }
+        else:
+            packet = {
+                "sid": sid,
+                "model": "sensor_motion.aq2",
+                "method": random.choice(["event.motion", "event.no_motion"]),
+                "params": []
+            }
+        self.events = self.events + 1
+        self.transport.sendto(json.dumps(packet).encode(), self.client)
+
+
+def run(host, port, latency, loss, event_rate, devices, capacity=0):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(loop.create_datagram_endpoint(
+        lambda: FakeGateway(latency, loss, event_rate, devices, capacity),
+        local_addr=(host, port)
+    ))
+    loop.run_forever()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Fake Lumi gateway")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=54321)
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help="mean reply latency in seconds")
+    parser.add_argument('--loss', type=float, default=0.0,
+                        help="probability of ignoring a request")
+    parser.add_argument('--event-rate', type=float, default=0,
+                        help="synthetic events per second")
+    parser.add_argument('--devices', type=int, default=20)
+    parser.add_argument('--capacity', type=float, default=0,
+                        help="requests served per second, 0 = unlimited")
+    args = parser.parse_args(argv)
+    run(args.host, args.port, args.latency, args.loss, args.event_rate,
+        args.devices, args.capacity)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
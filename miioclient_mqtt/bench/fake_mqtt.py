@@ -0,0 +1,78 @@
+import threading
+from types import SimpleNamespace
+
+
+class FakeMqtt:
+
+    # In-process stand-in for the paho based Mqtt client: no broker, no
+    # socket. Publishes are counted per topic and, like a broker would with
+    # the bridge's wildcard subscriptions, echoed back to on_message.
+    # Call inject() from a thread of your own to deliver commands the way
+    # paho's network thread does.
+
+    prefix = 'x/y'
+    will_topic = None
+
+    def __init__(self, echo=True):
+        self.echo = echo
+        self.on_connect = None
+        self.on_message = None
+        self.userdata = None
+        self.subscriptions = []
+        self.published = {}
+        self.publishes = 0
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def set_prefix(self, prefix):
+        self.prefix = prefix.rstrip('/') + '/'
+
+    def user_data_set(self, userdata):
+        self.userdata = userdata
+
+    def loop_start(self):
+        if self.on_connect is not None:
+            self.on_connect(self, self.userdata, {}, 0)
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def hold(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def subscribe(self, topic, qos=0, prefix=None):
+        self.subscriptions.append((prefix or self.prefix) + topic.lstrip('/'))
+
+    def publish(self, topic, payload, retain=False, prefix=None):
+        topic = (prefix or self.prefix) + topic.lstrip('/')
+        with self.lock:
+            self.publishes = self.publishes + 1
+            self.published[topic] = self.published.get(topic, 0) + 1
+        for listener in self.listeners:
+            listener(topic, payload)
+        if self.echo and self.matches(topic):
+            self.deliver(topic, payload, retain)
+
+    def matches(self, topic):
+        for subscription in self.subscriptions:
+            if subscription.endswith('#'):
+                if topic.startswith(subscription[:-1]):
+                    return True
+            elif subscription == topic:
+                return True
+        return False
+
+    def deliver(self, topic, payload, retain=False):
+        if type(payload) is str:
+            payload = payload.encode()
+        message = SimpleNamespace(topic=topic, payload=payload, retain=retain)
+        self.on_message(self, self.userdata, message)
+
+    def inject(self, topic, payload):
+        self.deliver(self.prefix + topic, payload)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+# Feeds the datagrams a gateway sent, as captured with miio.record, back
+# through Miio.handle_datagram (decode, then handle_msg and its publishes)
+# without a gateway or a broker.
+#
+#   python3 bench/replay.py recording [--speed 1] [--print] [--loop N]
+#
+# --speed 1 keeps the recorded timing, N plays N times faster, 0 as fast as
+# possible. --print writes every publish as "topic payload", so the output
+# of two versions of a parser can be diffed.
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+)
+from classes.Miio import Miio  # noqa: E402
+from classes.MqttPrefix import MqttPrefix  # noqa: E402
+from classes.Recorder import Recorder  # noqa: E402
+from classes.StateCache import StateCache  # noqa: E402
+from bench.fake_mqtt import FakeMqtt  # noqa: E402
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Gateway traffic replayer")
+    parser.add_argument('recording')
+    parser.add_argument('--speed', type=float, default=1,
+                        help="1 = recorded timing, 0 = as fast as possible")
+    parser.add_argument('--print', action='store_true',
+                        help="print every publish")
+    parser.add_argument('--loop', type=int, default=1,
+                        help="play the recording N times")
+    args = parser.parse_args(argv)
+
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    client = FakeMqtt(echo=False)
+    if args.print:
+        client.listeners.append(
+            lambda topic, payload: print(topic, payload)
+        )
+    mqtt = MqttPrefix(client, '/replay/')
+    miio = Miio(mqtt)
+    states = {'brightness': 0, 'light_rgb': 0}
+
+    # Load first, so reading the file is not part of the measure
+    datagrams = [
+        (timestamp, data)
+        for timestamp, direction, data in Recorder.read(args.recording)
+        if direction == Recorder.IN
+    ]
+    if not datagrams:
+        print("No incoming datagram in " + args.recording)
+        return
+    # Every replay publishes again, as after a restart of the bridge
+    replays = [datagrams] * args.loop
+
+    cpu = time.process_time()
+    start = time.monotonic()
+    for datagrams in replays:
+        mqtt.cache = StateCache()
+        first = datagrams[0][0]
+        played = time.monotonic()
+        for timestamp, data in datagrams:
+            if args.speed:
+                delay = played + (timestamp - first) / args.speed - \
+                    time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            miio.handle_datagram(data, states)
+    elapsed = time.monotonic() - start
+    cpu = time.process_time() - cpu
+
+    count = len(datagrams) * args.loop
+    print("datagrams   %d in %.3f s, %.0f /s" % (
+        count, elapsed, count / elapsed
+    ), file=sys.stderr)
+    print("publishes   %d, %.0f /s" % (
+        client.publishes, client.publishes / elapsed
+    ), file=sys.stderr)
+    print("cpu         %.1f us per datagram" % (
+        cpu / count * 1e6
+    ), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
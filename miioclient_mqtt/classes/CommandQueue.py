@@ -0,0 +1,110 @@
+import time
+import asyncio
+import itertools
+from collections import OrderedDict
+from classes.Metrics import metrics
+
+
+class CommandQueue:
+
+    # Commands for the gateway, coalesced per target: a command that is
+    # still waiting to be sent is replaced by a newer one with the same
+    # method for the same target (first element of the MiioMsg), so
+    # dragging a slider only sends the latest value, while a get_arming
+    # never replaces a set_arming. One-shot methods are always queued in
+    # order.
+    ONESHOT = ['play_music_new', 'set_sound_playing', 'internal.PING']
+
+    # Priority classes, the first non empty one is served first
+    SAFETY = 0
+    USER = 1
+    TELEMETRY = 2
+    EFFECT = 3
+    CLASSES = ['safety', 'user', 'telemetry', 'effect']
+    # Class of the commands queued without an explicit one
+    PRIORITY = {
+        'set_arming': SAFETY,
+        'set_sound_playing': SAFETY,
+        'get_arming': TELEMETRY,
+        'get_arm_wait_time': TELEMETRY,
+        'get_gateway_volume': TELEMETRY,
+        'get_alarming_volume': TELEMETRY,
+        'get_doorbell_volume': TELEMETRY,
+        'internal.PING': TELEMETRY,
+    }
+
+    def __init__(self, maxsize=100, name=''):
+        self.labels = (('gateway', name),)
+        self.maxsize = maxsize
+        # per class: key -> [enqueue time, deadline, item]
+        self.classes = [OrderedDict() for name in self.CLASSES]
+        # key -> class it waits in
+        self.where = {}
+        self.sequence = itertools.count()
+        self.event = asyncio.Event()
+        self.coalesced = 0
+        self.expired = 0
+
+    def key(self, item):
+        if item[1].get("method") in self.ONESHOT:
+            return next(self.sequence)
+        return (item[0], item[1].get("method"))
+
+    def put_nowait(self, item, priority=None, deadline=None):
+        # deadline: seconds after which the command is not worth sending
+        if priority is None:
+            priority = self.PRIORITY.get(item[1].get("method"), self.USER)
+        key = self.key(item)
+        now = time.monotonic()
+        expires = None if deadline is None else now + deadline
+        waiting = self.where.get(key)
+        if waiting == priority:
+            entry = self.classes[priority][key]
+            entry[1] = expires
+            entry[2] = item
+            self.coalesced = self.coalesced + 1
+            metrics.inc('queue_coalesced_total', self.labels)
+            return
+        if waiting is not None:
+            # latest value wins, in the class of the newest command
+            del self.classes[waiting][key]
+            self.coalesced = self.coalesced + 1
+            metrics.inc('queue_coalesced_total', self.labels)
+        elif len(self.where) >= self.maxsize:
+            raise asyncio.QueueFull()
+        self.classes[priority][key] = [now, expires, item]
+        self.where[key] = priority
+        self.event.set()
+
+    def discard(self, item):
+        # Drop the command waiting for the same target, item was sent
+        # directly
+        key = self.key(item)
+        waiting = self.where.pop(key, None)
+        if waiting is not None:
+            del self.classes[waiting][key]
+
+    async def get(self):
+        while True:
+            while not self.where:
+                self.event.clear()
+                await self.event.wait()
+            for priority, commands in enumerate(self.classes):
+                if commands:
+                    break
+            key, (enqueued, expires, item) = commands.popitem(last=False)
+            del self.where[key]
+            now = time.monotonic()
+            labels = self.labels + (('class', self.CLASSES[priority]),)
+            if expires is not None and now > expires:
+                self.expired = self.expired + 1
+                metrics.inc('queue_expired_total', labels)
+                continue
+            metrics.observe('queue_wait_seconds', now - enqueued, labels)
+            return item
+
+    def qsize(self):
+        return len(self.where)
+
+    def empty(self):
+        return not self.where
@@ -0,0 +1,35 @@
+class Device:
+
+    # One sub-device of the gateway (sensor, switch, ...), as last reported.
+    # Many of them live for the whole run, hence __slots__.
+
+    __slots__ = ('sid', 'model', 'kind', 'values', 'topics', 'last_seen')
+
+    def __init__(self, sid, model, kind):
+        self.sid = sid
+        self.model = model
+        self.kind = kind
+        # property -> last decoded value
+        self.values = {}
+        # property -> state topic, built on first use
+        self.topics = {}
+        self.last_seen = 0
+
+    def set(self, key, value):
+        # Stores the decoded value, returns the state topic of the property
+        if type(value) is not self.kind.decoders.get(key, type(value)):
+            value = self.kind.decode(key, value)
+        self.values[key] = value
+        topic = self.topics.get(key)
+        if topic is None:
+            topic = self.sid + "/" + key + "/state"
+            self.topics[key] = topic
+        return topic
+
+    def describe(self):
+        return {
+            'sid': self.sid,
+            'model': self.model,
+            'last_seen': self.last_seen,
+            'values': self.values,
+        }
@@ -0,0 +1,19 @@
+class DeviceModel:
+
+    # Property decoders of one model, shared by all its devices
+
+    __slots__ = ('model', 'decoders')
+
+    def __init__(self, model, decoders):
+        self.model = model
+        self.decoders = decoders
+
+    def decode(self, key, value):
+        # Unknown properties and values that do not fit are kept as sent
+        decoder = self.decoders.get(key)
+        if decoder is None:
+            return value
+        try:
+            return decoder(value)
+        except (TypeError, ValueError):
+            return value
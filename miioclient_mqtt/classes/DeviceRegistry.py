@@ -0,0 +1,57 @@
+import time
+from classes.Device import Device
+from classes.DeviceModel import DeviceModel
+
+
+class DeviceRegistry:
+
+    # Sub-devices of one gateway by sid, created from the packets carrying
+    # a model
+
+    # Properties of every model
+    COMMON = {'voltage': int, 'battery': int}
+    # Model name part (sensor_ht of lumi.sensor_ht.v1) -> property decoders
+    MODELS = {
+        'sensor_ht': {'temperature': int, 'humidity': int},
+        'weather': {'temperature': int, 'humidity': int, 'pressure': int},
+        'sensor_motion': {'lux': int, 'illumination': int},
+        'magnet': {'status': str},
+        'sensor_magnet': {'status': str},
+        'sensor_wleak': {'status': str},
+        'smoke': {'alarm': int, 'density': int},
+        'natgas': {'alarm': int, 'density': int},
+        'plug': {'load_power': float, 'energy_consumed': float},
+        'ctrl_neutral1': {'channel_0': str},
+        'ctrl_neutral2': {'channel_0': str, 'channel_1': str},
+    }
+
+    def __init__(self):
+        self.devices = {}
+        self.models = {}
+
+    def model(self, name):
+        # Decoders are looked up once per model
+        kind = self.models.get(name)
+        if kind is None:
+            decoders = dict(self.COMMON)
+            for part in name.split('.'):
+                if part in self.MODELS:
+                    decoders.update(self.MODELS[part])
+                    break
+            kind = DeviceModel(name, decoders)
+            self.models[name] = kind
+        return kind
+
+    def seen(self, sid, model):
+        device = self.devices.get(sid)
+        if device is None or device.model != model:
+            device = Device(sid, model, self.model(model))
+            self.devices[sid] = device
+        device.last_seen = time.time()
+        return device
+
+    def get(self, sid):
+        return self.devices.get(sid)
+
+    def describe(self):
+        return [device.describe() for device in self.devices.values()]
@@ -0,0 +1,145 @@
+import json
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Effect:
+
+    # A light effect precomputed as a table of (brightness, rgb) frames,
+    # played at a fixed frame rate on the monotonic clock of the event loop.
+    # Frames are looked up from the current time, so a late tick skips to
+    # the frame that is due instead of replaying the ones it missed.
+
+    # The table is built in one go in the event loop: a longer one is
+    # refused (ValueError, logged by the Router) before anything is built
+    MAX_FRAMES = 10000
+
+    def __init__(self, name, frames, fps, duration, repeat=True):
+        if not frames:
+            raise ValueError("Effect without frames")
+        self.name = name
+        self.frames = frames
+        self.fps = fps
+        self.duration = duration
+        self.repeat = repeat
+        self.start = 0
+        self.end = 0
+        self.last = None
+        self.sent = 0
+        self.dropped = 0
+
+    def begin(self, now):
+        self.start = now
+        self.end = now + self.duration
+
+    def frame(self, now):
+        # Frame due at now, None once the effect is over
+        if now >= self.end:
+            return None
+        index = int((now - self.start) * self.fps)
+        if self.repeat:
+            index = index % len(self.frames)
+        elif index >= len(self.frames):
+            index = len(self.frames) - 1
+        return self.frames[index]
+
+    def next_tick(self, now):
+        index = int((now - self.start) * self.fps) + 1
+        return min(self.start + index / self.fps, self.end)
+
+    @classmethod
+    def frame_count(cls, seconds, fps):
+        # Frames over seconds, not a number of them is refused as well
+        count = seconds * fps
+        if not count <= cls.MAX_FRAMES:
+            raise ValueError(
+                "Effect of %g frames, at most %d" % (count, cls.MAX_FRAMES)
+            )
+        return max(1, int(round(count)))
+
+    @staticmethod
+    def parse_color(value, brightness):
+        # rrggbb, or bbrrggbb with the brightness in front
+        value = int(str(value), 16)
+        if value > 0xffffff:
+            return divmod(value, 0x1000000)
+        return int(brightness), value
+
+    @staticmethod
+    def gradient(start, target, count):
+        # count frames going linearly from start to target, both included,
+        # each frame being (brightness, rgb)
+        if count < 2:
+            return [target]
+        ends = []
+        for brightness, color in (start, target):
+            ends.append([
+                brightness,
+                color // 0x10000 % 0x100,
+                color // 0x100 % 0x100,
+                color % 0x100
+            ])
+        if numpy is not None:
+            steps = numpy.linspace(ends[0], ends[1], count).round()
+            steps = steps.astype(int)
+            packed = steps[:, 1] * 0x10000 + steps[:, 2] * 0x100 + steps[:, 3]
+            return list(zip(steps[:, 0].tolist(), packed.tolist()))
+        frames = []
+        for i in range(count):
+            channels = [
+                int(round(c0 + (c1 - c0) * i / (count - 1)))
+                for c0, c1 in zip(ends[0], ends[1])
+            ]
+            frames.append((
+                channels[0],
+                channels[1] * 0x10000 + channels[2] * 0x100 + channels[3]
+            ))
+        return frames
+
+    @classmethod
+    def blink(cls, start, target, duration, fps, interval=0.5):
+        # Alternate between start and target every interval seconds
+        count = cls.frame_count(interval, fps)
+        return cls('blink', [start] * count + [target] * count, fps, duration)
+
+    @classmethod
+    def slowblink(cls, target, pulse, duration, fps):
+        # Fade from off to target over pulse seconds, over and over
+        count = cls.frame_count(pulse, fps)
+        frames = cls.gradient((0, 0), target, count)
+        return cls('slowblink', frames, fps, duration)
+
+    @classmethod
+    def timeline(cls, spec, brightness, fps):
+        # {"keyframes": [{"t": 0, "rgb": "ff0000", "brightness": 50}, ...],
+        #  "duration": 30, "repeat": true, "step": false}
+        if type(spec) is not dict:
+            spec = json.loads(spec)
+        keyframes = []
+        for keyframe in spec['keyframes']:
+            keyframes.append((
+                float(keyframe['t']),
+                cls.parse_color(
+                    keyframe['rgb'],
+                    keyframe.get('brightness', brightness)
+                )
+            ))
+        keyframes.sort(key=lambda keyframe: keyframe[0])
+        if keyframes[0][0] != 0:
+            keyframes.insert(0, (0.0, keyframes[0][1]))
+        cls.frame_count(keyframes[-1][0] - keyframes[0][0], fps)
+        frames = []
+        for (t0, start), (t1, target) in zip(keyframes, keyframes[1:]):
+            count = cls.frame_count(t1 - t0, fps)
+            if spec.get('step', False):
+                frames.extend([start] * count)
+            else:
+                frames.extend(cls.gradient(start, target, count + 1)[:-1])
+        frames.append(keyframes[-1][1])
+        span = len(frames) / fps
+        duration = float(spec.get('duration', span))
+        repeat = bool(spec.get('repeat', duration > span))
+        return cls('timeline', frames, fps, duration, repeat)
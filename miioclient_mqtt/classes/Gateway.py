@@ -0,0 +1,720 @@
+import json
+import time
+import asyncio
+import logging
+import functools
+from classes.CommandQueue import CommandQueue
+from classes.Effect import Effect
+from classes.Liveness import Liveness
+from classes.Metrics import metrics
+from classes.Miio import Miio
+from classes.MiioMsg import MiioMsg
+from classes.MiioProtocol import MiioProtocol
+from classes.MqttPrefix import MqttPrefix
+from classes.RateLimiter import RateLimiter
+from classes.Recorder import Recorder
+from classes.Router import Router
+from classes.Snapshot import Snapshot
+from classes.StreamFilter import StreamFilter
+
+# Constants
+snapshot_delay = 5
+# Commands accepted in one batch, sent outside of the in-flight window
+batch_max = 32
+# Seconds a value served on get/<topic> stays valid without asking the
+# gateway again
+value_ttl = 60
+
+
+def queueAppend(queue, item, priority=None, deadline=None):
+    if (item):
+        try:
+            queue.put_nowait(item, priority, deadline)
+        except asyncio.QueueFull:
+            logging.warning("Queue full, dropping: " + str(item[1]))
+            return False
+        return True
+    else:
+        return False
+
+
+class Gateway:
+
+    # One Lumi gateway: its own UDP socket, command queue, id counter,
+    # states and liveness, publishing under its own MQTT prefix
+
+    def __init__(self, config, mqtt, loop):
+        self.config = config
+        self.loop = loop
+        self.address = (config['broker'], config.get('port', 54321))
+        self.states = self.initial_states(config)
+        # settings topic -> params last acknowledged by the gateway
+        self.confirmed = {}
+        self.snapshot = None
+        self.snapshot_timer = None
+        if config.get('snapshot'):
+            self.snapshot = Snapshot(config['snapshot'])
+            self.restore()
+        self.queue = CommandQueue(maxsize=100, name=config['prefix'])
+        self.mqtt = MqttPrefix(mqtt, config['prefix'])
+        self.mqtt.retain = config.get('retain', False)
+        # Debounce, rate limits and window summaries of chatty sensors
+        self.streams = None
+        if config.get('streams'):
+            self.streams = StreamFilter(
+                self.mqtt,
+                loop,
+                config['streams'],
+                config['prefix']
+            )
+        self.miio = Miio(
+            self.streams or self.mqtt,
+            window=config.get('window', 4),
+            timeout=config.get('timeout', 2),
+            retries=config.get('retries', 1),
+            name=config['prefix']
+        )
+        if config.get('record'):
+            self.miio.recorder = Recorder(config['record'])
+        # Send pace, adapted to the replies; rate: false to disable
+        rate = config.get('rate', {})
+        if rate is not False:
+            self.miio.limiter = RateLimiter(
+                loop,
+                rate=rate.get('initial', 20),
+                minimum=rate.get('min', 1),
+                maximum=rate.get('max', 200),
+                burst=rate.get('burst', 10),
+                increase=rate.get('increase', 10),
+                decrease=rate.get('decrease', 0.5),
+                delay=rate.get('delay', 0.25)
+            )
+        labels = (('gateway', config['prefix']),)
+        metrics.gauge('queue_depth', self.queue.qsize, labels)
+        metrics.gauge('miio_inflight', lambda: len(self.miio.pending), labels)
+        metrics.gauge(
+            'miio_srtt_seconds',
+            lambda: self.miio.srtt or 0,
+            labels
+        )
+        metrics.gauge(
+            'miio_online',
+            lambda: int(self.liveness.state == Liveness.ONLINE),
+            labels
+        )
+        metrics.gauge(
+            'miio_devices',
+            lambda: len(self.miio.devices.devices),
+            labels
+        )
+        if self.miio.limiter is not None:
+            metrics.gauge(
+                'miio_rate',
+                lambda: self.miio.limiter.rate,
+                labels
+            )
+            metrics.gauge(
+                'miio_rate_cuts',
+                lambda: self.miio.limiter.cuts,
+                labels
+            )
+        ping = config.get('ping', {})
+        self.liveness = Liveness(
+            loop,
+            self.ping,
+            self.report,
+            idle=ping.get('idle', 60),
+            misses=ping.get('misses', 3),
+            offline=ping.get('offline', 15),
+            keepalive=ping.get('keepalive', 300)
+        )
+        # get/<topic>: values read back from the gateway, by topic
+        self.readable = self.readable_values()
+        ttl = config.get('ttl', {})
+        if type(ttl) is not dict:
+            ttl = {'default': ttl}
+        self.ttl = ttl
+        # topic -> time.time() of the last value confirmed by the gateway
+        self.fetched = {}
+        # topic -> ids of the get requests waiting for the same query
+        self.queries = {}
+        self.router = Router(self.routes())
+        self.setting_topics = set(req[0] for req, tone in self.settings())
+        self.fps = config.get('effects', {}).get('fps', 2)
+        self.effect = None
+        self.effect_timer = None
+        self.transport = None
+
+    async def start(self):
+        # Create a UDP endpoint at client side
+        self.transport, protocol = await self.loop.create_datagram_endpoint(
+            lambda: MiioProtocol(self.on_datagram),
+            remote_addr=self.address
+        )
+        self.miio.transport = self.transport
+        # Send a PING first
+        self.liveness.start()
+        # Is Gateway armed?
+        queueAppend(self.queue, MiioMsg.get_arming())
+        # Then only the settings the gateway did not confirm already, all at
+        # once: the sender keeps them pipelined
+        silent = self.config.get('silent_start', False)
+        audible = False
+        for req, tone in self.settings():
+            if tone and silent:
+                continue
+            if self.confirmed.get(req[0]) == req[1].get('params'):
+                continue
+            if queueAppend(self.queue, req):
+                audible = audible or tone
+        if audible:
+            # Turn OFF sound as previous commands will make the gateway
+            # play tones
+            queueAppend(self.queue, MiioMsg.stop_sound())
+        self.loop.create_task(self.sender())
+
+    def close(self):
+        self.liveness.close()
+        if self.streams is not None:
+            self.streams.close()
+        if self.transport is not None:
+            self.transport.close()
+        if self.miio.recorder is not None:
+            self.miio.recorder.close()
+        if self.snapshot is not None:
+            self.save_snapshot()
+
+    def settings(self):
+        # Commands applying the states to the gateway, in init order, and
+        # whether the gateway plays a tone when receiving them
+        return [
+            # Set time in seconds after which alarm is really armed
+            (MiioMsg.set_arming_time(self.states['arming_time']), False),
+            # Set duration of alarm if triggered
+            (MiioMsg.set_alarm_duration(self.states['alarm_duration']), True),
+            (MiioMsg.set_alarm_volume(self.states['alarm_volume']), True),
+            (MiioMsg.set_alarm_sound(self.states['alarm_sound']), True),
+            (
+                MiioMsg.set_doorbell_volume(self.states['doorbell_volume']),
+                True
+            ),
+            (MiioMsg.set_doorbell_sound(self.states['doorbell_sound']), True),
+            # Set intensity + color
+            (
+                MiioMsg.set_rgb(
+                    self.states['brightness'],
+                    self.states['light_rgb']
+                ),
+                False
+            ),
+        ]
+
+    def restore(self):
+        # States changed at runtime survive a restart, unless their
+        # initial_states entry was changed in the configuration since
+        data = self.snapshot.load()
+        initial = data.get('initial', {})
+        for key, value in data.get('states', {}).items():
+            if key in self.states and initial.get(key) == self.states[key]:
+                self.states[key] = value
+        self.confirmed = data.get('confirmed', {})
+
+    def save_snapshot(self):
+        if self.snapshot_timer is not None:
+            self.snapshot_timer.cancel()
+            self.snapshot_timer = None
+        self.snapshot.save({
+            'initial': self.initial_states(self.config),
+            'states': self.states,
+            'confirmed': self.confirmed,
+        })
+
+    def snapshot_changed(self):
+        # Saves are grouped, an effect confirms several frames per second
+        if self.snapshot is not None and self.snapshot_timer is None:
+            self.snapshot_timer = self.loop.call_later(
+                snapshot_delay,
+                self.save_snapshot
+            )
+
+    def on_reply(self, req, future):
+        miio_msg = future.result()
+        if miio_msg is None or 'error' in miio_msg:
+            return
+        self.confirmed[req[0]] = req[1].get('params')
+        self.snapshot_changed()
+
+    def initial_states(self, config):
+        return {
+            'sound':
+                config.get('initial_states', {}).get('sound', 2),
+            'sound_volume':
+                config.get('initial_states', {}).get('sound_volume', 50),
+            'light_rgb':
+                int(
+                    config.get('initial_states', {}).get(
+                        'light_rgb',
+                        'ffffff'
+                    ),
+                    16
+                ),
+            'doorbell_volume':
+                config.get('initial_states', {}).get('doorbell_volume', 25),
+            'doorbell_sound':
+                config.get('initial_states', {}).get('doorbell_sound', 11),
+            'alarm_volume':
+                config.get('initial_states', {}).get('alarm_volume', 90),
+            'alarm_sound':
+                config.get('initial_states', {}).get('alarm_sound', 2),
+            'arming_time':
+                config.get('initial_states', {}).get('arming_time', 30),
+            'alarm_duration':
+                config.get('initial_states', {}).get('alarm_duration', 1200),
+            'brightness':
+                config.get('initial_states', {}).get('brightness', 54),
+        }
+
+    def routes(self):
+        # MQTT topic -> handler, parser
+        return [
+            ('heartbeat', self.on_heartbeat, Router.text),
+            ('devices', self.on_devices, Router.text),
+            ('batch', self.on_batch, Router.text),
+            ('get/#', self.on_get, Router.text),
+            ('effect/blink', self.on_effect_blink, Router.text),
+            ('effect/slowblink', self.on_effect_slowblink, Router.text),
+            ('effect/timeline', self.on_effect_timeline, Router.text),
+        ] + [
+            (topic, functools.partial(self.on_command, build), parser)
+            for topic, (build, parser) in self.commands().items()
+        ]
+
+    def commands(self):
+        # MQTT topic -> builder, parser of the gateway commands, also
+        # accepted in a batch. A builder gets the value and the states to
+        # read from and returns the request (or None) and the states it sets
+        return {
+            'alarm': (self.build_alarm, Router.lower),
+            'alarm/time_to_activate': (self.build_arming_time, Router.integer),
+            'alarm/duration': (self.build_alarm_duration, Router.integer),
+            'light': (self.build_light, Router.lower),
+            'brightness': (self.build_brightness, Router.integer),
+            'rgb': (self.build_rgb, Router.hexadecimal),
+            'sound': (self.build_sound, Router.lower),
+            'sound/sound': (self.build_sound_sound, Router.integer),
+            'sound/volume': (self.build_sound_volume, Router.integer),
+            'sound/alarming/volume': (self.build_alarm_volume, Router.integer),
+            'sound/alarming/sound': (self.build_alarm_sound, Router.text),
+            'sound/doorbell/volume':
+                (self.build_doorbell_volume, Router.integer),
+            'sound/doorbell/sound': (self.build_doorbell_sound, Router.text),
+        }
+
+    def on_heartbeat(self, value):
+        queueAppend(self.queue, MiioMsg.get_arming())
+
+    def on_devices(self, value):
+        # Known sub-devices with their last values and when they were seen
+        self.mqtt.publish(
+            'internal/devices',
+            json.dumps(self.miio.devices.describe(), sort_keys=True)
+        )
+
+    def readable_values(self):
+        # get/<topic> -> states key holding the value (None: the last value
+        # published on <topic>/state), command reading it back from the
+        # gateway once expired (None: never asked). Any other topic is
+        # answered from its last published state.
+        return {
+            'alarm': (None, MiioMsg.get_arming),
+            'alarm/time_to_activate':
+                ('arming_time', MiioMsg.get_arming_time),
+            'alarm/duration': ('alarm_duration', None),
+            'brightness': ('brightness', None),
+            'rgb': ('light_rgb', None),
+            'sound/sound': ('sound', None),
+            'sound/volume': ('sound_volume', MiioMsg.get_volume),
+            'sound/alarming/volume':
+                ('alarm_volume', MiioMsg.get_alarm_volume),
+            'sound/alarming/sound': ('alarm_sound', None),
+            'sound/doorbell/volume':
+                ('doorbell_volume', MiioMsg.get_doorbell_volume),
+            'sound/doorbell/sound': ('doorbell_sound', None),
+        }
+
+    def on_get(self, topic, value):
+        # Answered on value/<topic> with {"value", "age"} (and "id", the
+        # request payload if any), from memory while fresh. Concurrent
+        # requests for an expired value share one gateway query.
+        request_id = value.strip() or None
+        key, query = self.readable.get(topic, (None, None))
+        if query is not None:
+            updated = self.value_updated(topic)
+            ttl = self.ttl.get(topic, self.ttl.get('default', value_ttl))
+            if updated is None or time.time() - updated > ttl:
+                if self.transport is None:
+                    # nothing would ever send the query: what is known
+                    self.answer(topic, [request_id], 'gateway not started')
+                    return
+                waiting = self.queries.get(topic)
+                if waiting is not None:
+                    waiting.append(request_id)
+                    return
+                if queueAppend(self.queue, query()):
+                    self.queries[topic] = [request_id]
+                    return
+                self.answer(topic, [request_id], 'queue full')
+                return
+        self.answer(topic, [request_id])
+
+    def value_updated(self, topic):
+        # Last time the gateway told the value, if known
+        times = [
+            self.fetched.get(topic),
+            self.mqtt.cache.updated.get(topic + '/state')
+        ]
+        times = [updated for updated in times if updated is not None]
+        return max(times) if times else None
+
+    def on_query(self, topic, key, future):
+        miio_msg = future.result()
+        error = None
+        if miio_msg is None:
+            error = 'no reply'
+        elif 'error' in miio_msg:
+            error = str(miio_msg['error'])
+        else:
+            result = miio_msg.get('result')
+            if key is not None and result and \
+                    self.states.get(key) != result[0]:
+                self.states[key] = result[0]
+                self.snapshot_changed()
+        self.answer(topic, self.queries.pop(topic, []), error)
+
+    def answer(self, topic, request_ids, error=None):
+        key, query = self.readable.get(topic, (None, None))
+        if key is not None:
+            value = self.states[key]
+            if key == 'light_rgb':
+                value = format(value, 'x').upper()
+            else:
+                value = str(value)
+        else:
+            value = self.mqtt.cache.get(topic + '/state')
+            if value is None:
+                value = self.mqtt.cache.get(topic)
+        updated = self.value_updated(topic)
+        reply = {
+            'value': value,
+            'age': None if updated is None else
+            round(time.time() - updated, 1),
+        }
+        if value is None:
+            error = error or 'unknown'
+        if error is not None:
+            reply['error'] = error
+        for request_id in request_ids:
+            if request_id is not None:
+                reply['id'] = request_id
+            else:
+                reply.pop('id', None)
+            self.mqtt.publish('value/' + topic, json.dumps(reply))
+
+    def on_command(self, build, value):
+        req, updates = build(value, self.states)
+        if req is None and not updates:
+            return
+        if req is None or queueAppend(self.queue, req):
+            self.states.update(updates)
+            if req is None:
+                self.snapshot_changed()
+
+    def on_batch(self, value):
+        # A JSON list of {"topic": ..., "payload": ...}, or an object
+        # {"id": ..., "commands": [...]} to tell the results apart. Nothing
+        # is sent unless every command is valid; then they all go out at
+        # once and a single result is published on batch/result.
+        batch_id = None
+        try:
+            commands = json.loads(value)
+            if type(commands) is dict:
+                batch_id = commands.get('id')
+                commands = commands['commands']
+            reqs, keys, states = self.parse_batch(commands)
+        except (ValueError, KeyError, TypeError) as inst:
+            logging.warning("Bad batch: " + str(inst))
+            self.mqtt.publish('batch/result', json.dumps({
+                'id': batch_id,
+                'ok': False,
+                'error': str(inst),
+            }))
+            return
+        # Accepted: the states are set as if the commands came one by one
+        self.states.update(states)
+        self.snapshot_changed()
+        futures = {}
+        for key, req in reqs.items():
+            # an older command still waiting would undo this one
+            self.queue.discard(req)
+            future = self.miio.request(req, self.states, window=False)
+            self.track(req, future)
+            futures[key] = future
+        self.loop.create_task(
+            self.batch_result(batch_id, commands, keys, futures)
+        )
+
+    def parse_batch(self, commands):
+        # -> requests by queue key (the last command for a target wins, in
+        # the place of the first one), key of each command (None when it
+        # only sets a state), states once all are applied
+        if type(commands) is not list or not commands:
+            raise ValueError("expected a non empty list of commands")
+        if len(commands) > batch_max:
+            raise ValueError("more than " + str(batch_max) + " commands")
+        if self.transport is None:
+            raise ValueError("gateway not started")
+        builders = self.commands()
+        states = dict(self.states)
+        reqs = {}
+        keys = []
+        for index, command in enumerate(commands):
+            try:
+                topic = command['topic']
+                if topic not in builders:
+                    raise ValueError("unknown topic")
+                build, parser = builders[topic]
+                payload = command['payload']
+                if type(payload) is not str:
+                    payload = json.dumps(payload)
+                req, updates = build(parser(payload), states)
+                if req is None and not updates:
+                    raise ValueError("invalid value " + payload)
+            except (ValueError, KeyError, TypeError) as inst:
+                raise ValueError(
+                    "command " + str(index) + " " + json.dumps(command) +
+                    ": " + str(inst)
+                )
+            states.update(updates)
+            if req is None:
+                keys.append(None)
+                continue
+            key = self.queue.key(req)
+            reqs[key] = req
+            keys.append(key)
+        return reqs, keys, states
+
+    async def batch_result(self, batch_id, commands, keys, futures):
+        started = time.monotonic()
+        if futures:
+            # nothing to wait for when the batch only set states
+            await asyncio.wait(futures.values())
+        elapsed = time.monotonic() - started
+        results = []
+        for command, key in zip(commands, keys):
+            result = {'topic': command['topic']}
+            if key is None:
+                result['result'] = None
+            else:
+                miio_msg = futures[key].result()
+                if miio_msg is None:
+                    result['error'] = 'no reply'
+                elif 'error' in miio_msg:
+                    result['error'] = miio_msg['error']
+                else:
+                    result['result'] = miio_msg.get('result')
+            results.append(result)
+        ok = all('error' not in result for result in results)
+        metrics.observe('batch_seconds', elapsed, self.miio.labels)
+        if not ok:
+            metrics.inc('batch_failed_total', self.miio.labels)
+        self.mqtt.publish('batch/result', json.dumps({
+            'id': batch_id,
+            'ok': ok,
+            'seconds': round(elapsed, 3),
+            'results': results,
+        }))
+
+    def build_alarm(self, value, states):
+        return MiioMsg.set_arming(value), {}
+
+    def build_arming_time(self, value, states):
+        return MiioMsg.set_arming_time(value), {'arming_time': value}
+
+    def build_alarm_duration(self, value, states):
+        return MiioMsg.set_alarm_duration(value), {'alarm_duration': value}
+
+    def build_light(self, value, states):
+        return MiioMsg.set_light(value), {}
+
+    def build_brightness(self, value, states):
+        return (
+            MiioMsg.set_rgb(value, states['light_rgb']),
+            {'brightness': value}
+        )
+
+    def build_rgb(self, value, states):
+        return (
+            MiioMsg.set_rgb(states['brightness'], value),
+            {'light_rgb': value}
+        )
+
+    def build_sound(self, value, states):
+        if value == "on":
+            return (
+                MiioMsg.play_sound(states['sound'], states['sound_volume']),
+                {}
+            )
+        if value == "off":
+            return MiioMsg.stop_sound(), {}
+        return None, {}
+
+    def build_sound_sound(self, value, states):
+        return None, {'sound': value}
+
+    def build_sound_volume(self, value, states):
+        return MiioMsg.set_volume(value), {'sound_volume': value}
+
+    def build_alarm_volume(self, value, states):
+        return MiioMsg.set_alarm_volume(value), {'alarm_volume': value}
+
+    def build_alarm_sound(self, value, states):
+        return MiioMsg.set_alarm_sound(value), {'alarm_sound': value}
+
+    def build_doorbell_volume(self, value, states):
+        return (
+            MiioMsg.set_doorbell_volume(value),
+            {'doorbell_volume': value}
+        )
+
+    def build_doorbell_sound(self, value, states):
+        return MiioMsg.set_doorbell_sound(value), {'doorbell_sound': value}
+
+    def on_effect_blink(self, value):
+        # color:color:duration
+        command_parts = value.split(':', 3)
+        self.start_effect(Effect.blink(
+            Effect.parse_color(command_parts[0], self.states['brightness']),
+            Effect.parse_color(command_parts[1], self.states['brightness']),
+            int(command_parts[2]),
+            self.fps
+        ))
+
+    def on_effect_slowblink(self, value):
+        # color:pulse:duration
+        command_parts = value.split(':', 3)
+        self.start_effect(Effect.slowblink(
+            Effect.parse_color(command_parts[0], 100),
+            int(command_parts[1]),
+            int(command_parts[2]),
+            self.fps
+        ))
+
+    def on_effect_timeline(self, value):
+        # JSON keyframes, see Effect.timeline
+        self.start_effect(
+            Effect.timeline(value, self.states['brightness'], self.fps)
+        )
+
+    def start_effect(self, effect):
+        effect.begin(self.loop.time())
+        self.effect = effect
+        queueAppend(self.queue, MiioMsg.set_light('on'), CommandQueue.EFFECT)
+        if self.effect_timer is not None:
+            self.effect_timer.cancel()
+        self.effect_tick()
+
+    def effect_tick(self):
+        self.effect_timer = None
+        effect = self.effect
+        now = self.loop.time()
+        frame = effect.frame(now)
+        if frame is None:
+            logging.debug(
+                "Effect " + effect.name + " done, frames sent: " +
+                str(effect.sent) + " dropped: " + str(effect.dropped)
+            )
+            self.effect = None
+            queueAppend(
+                self.queue,
+                MiioMsg.set_light('off'),
+                CommandQueue.EFFECT
+            )
+            return
+        if frame != effect.last:
+            # Frames are served after every other command class; with a
+            # full window drop this one, the next tick sends whatever is
+            # due then
+            if not self.miio.busy():
+                effect.last = frame
+                effect.sent = effect.sent + 1
+                metrics.inc('effect_frames_sent_total', self.miio.labels)
+                # a frame not sent by the next one is stale
+                queueAppend(
+                    self.queue,
+                    MiioMsg.set_rgb(frame[0], frame[1]),
+                    CommandQueue.EFFECT,
+                    1 / effect.fps
+                )
+            else:
+                effect.dropped = effect.dropped + 1
+                metrics.inc('effect_frames_dropped_total', self.miio.labels)
+        self.effect_timer = self.loop.call_at(
+            effect.next_tick(now),
+            self.effect_tick
+        )
+
+    def on_datagram(self, data):
+        self.liveness.alive()
+        # Publishes of one packet leave together
+        self.mqtt.hold()
+        try:
+            self.miio.handle_datagram(data, self.states)
+        finally:
+            self.mqtt.flush()
+
+    async def sender(self):
+        while True:
+            # Wait for a free slot in the in-flight window first, so commands
+            # keep coalescing in the queue while the gateway is busy. The reply
+            # is matched by id in Miio.handle_datagram
+            await self.miio.acquire()
+            if self.miio.limiter is not None:
+                await self.miio.limiter.wait()
+            # req : topic , miio_msg, state_update
+            req = await self.queue.get()
+            self.track(req, self.miio.request(req, self.states))
+
+    def track(self, req, future):
+        # Callbacks run in the order added, on_done first
+        if req[1].get('method') == Miio.PING:
+            future.add_done_callback(self.on_pong)
+        else:
+            future.add_done_callback(functools.partial(self.on_done, req[0]))
+        if req[0] in self.setting_topics and 'params' in req[1]:
+            future.add_done_callback(functools.partial(self.on_reply, req))
+        if req[0] in self.queries and 'params' not in req[1]:
+            future.add_done_callback(functools.partial(
+                self.on_query,
+                req[0],
+                self.readable[req[0]][0]
+            ))
+
+    def on_done(self, topic, future):
+        miio_msg = future.result()
+        if miio_msg is None:
+            self.liveness.suspect()
+        elif 'error' not in miio_msg:
+            # the value of topic is as the gateway says, changed or not
+            self.fetched[topic] = time.time()
+
+    def on_pong(self, future):
+        if future.result() is None:
+            self.liveness.missed()
+        else:
+            self.liveness.answered()
+
+    def ping(self):
+        return queueAppend(self.queue, MiioMsg.ping())
+
+    def report(self, state):
+        self.mqtt.publish('internal/state', state, True)
@@ -0,0 +1,110 @@
+import logging
+
+
+class Liveness:
+
+    # Reachability of a gateway, told by its own traffic: any datagram
+    # received proves it alive, any request left without reply makes it
+    # suspect. It is pinged after `idle` seconds of silence or when
+    # suspect, again right after each missed ping, and every `offline`
+    # seconds once `misses` pings in a row went unanswered. ONLINE /
+    # OFFLINE are only reported on transitions. A ping also goes out every
+    # `keepalive` seconds: miio_client forgets the event subscribers it did
+    # not hear from for 10 minutes.
+
+    ONLINE = 'ONLINE'
+    OFFLINE = 'OFFLINE'
+
+    def __init__(self, loop, ping, report, idle=60, misses=3, offline=15,
+                 keepalive=300):
+        self.loop = loop
+        # ping() queues a ping, False when the queue is full,
+        # report(state) publishes the state
+        self.ping = ping
+        self.report = report
+        self.idle = idle
+        self.misses = misses
+        self.offline = offline
+        self.keepalive = keepalive
+        self.state = None
+        self.last_seen = 0
+        self.missed_count = 0
+        self.probing = False
+        self.probe_sent = 0
+        self.timer = None
+
+    def start(self):
+        self.probe()
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def schedule(self, delay):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = self.loop.call_later(delay, self.tick)
+
+    def tick(self):
+        self.timer = None
+        now = self.loop.time()
+        quiet = now - self.last_seen
+        silent = now - self.probe_sent
+        if self.state == self.ONLINE and self.missed_count == 0 and \
+                quiet < self.idle and silent < self.keepalive:
+            self.schedule(min(self.idle - quiet, self.keepalive - silent))
+        else:
+            self.probe()
+
+    def probe(self):
+        # Next step is decided by the reply, or the lack of it
+        if not self.probing:
+            self.probing = True
+            self.probe_sent = self.loop.time()
+            if not self.ping():
+                # as good as unanswered, but no use retrying right away
+                self.missed(self.offline)
+
+    def alive(self):
+        # Called for every datagram, keep it cheap
+        self.last_seen = self.loop.time()
+        self.missed_count = 0
+        if self.state != self.ONLINE:
+            self.transition(self.ONLINE)
+            self.schedule(self.idle)
+
+    def answered(self):
+        # The ping got its reply
+        self.probing = False
+        self.schedule(self.idle)
+
+    def suspect(self):
+        # A command went unanswered
+        self.probe()
+
+    def missed(self, retry=0):
+        # The ping went unanswered, the next one goes after retry seconds
+        # unless the gateway is OFFLINE
+        self.probing = False
+        if self.last_seen >= self.probe_sent:
+            # but something else came in meanwhile
+            self.schedule(self.idle)
+            return
+        self.missed_count = self.missed_count + 1
+        if self.missed_count >= self.misses:
+            if self.state != self.OFFLINE:
+                self.transition(self.OFFLINE)
+            self.schedule(self.offline)
+        else:
+            self.schedule(retry)
+
+    def transition(self, state):
+        logging.info("Gateway " + state)
+        self.state = state
+        self.report(state)
+
+    def announce(self):
+        # After an MQTT reconnection
+        if self.state is not None:
+            self.report(self.state)
@@ -0,0 +1,158 @@
+import json
+import asyncio
+import logging
+
+
+class Metrics:
+
+    # Counters, histograms and sampled gauges of the bridge hot paths,
+    # rendered in the Prometheus text format. Labels are tuples of
+    # (name, value) pairs so they can be used as dict keys.
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+    HELP = {
+        'miio_rtt_seconds': "Gateway request round trip",
+        'miio_requests_total': "Requests sent to the gateway",
+        'miio_retries_total': "Requests resent after a missed deadline",
+        'miio_timeouts_total': "Requests given up without reply",
+        'miio_events_total': "Gateway packets handled, by method",
+        'queue_wait_seconds': "Time commands waited in the queue",
+        'queue_coalesced_total': "Commands replaced by a newer one",
+        'queue_expired_total': "Commands dropped past their deadline",
+        'queue_depth': "Commands waiting to be sent",
+        'miio_inflight': "Requests waiting for a reply",
+        'miio_devices': "Sub-devices seen",
+        'miio_srtt_seconds': "Smoothed gateway round trip",
+        'miio_online': "1 while the gateway answers",
+        'miio_rate': "Requests per second the gateway is paced at",
+        'miio_rate_cuts': "Send rate decreases on loss or slow replies",
+        'mqtt_publishes_total': "MQTT publishes, by topic",
+        'mqtt_dropped_total': "MQTT publishes dropped, broker behind",
+        'effect_frames_sent_total': "Light effect frames sent",
+        'effect_frames_dropped_total': "Light effect frames dropped",
+        'batch_seconds': "Time until every command of a batch answered",
+        'batch_failed_total': "Batches with a command failed or unanswered",
+        'stream_suppressed_total': "Sensor values replaced before publish",
+        'stream_windows_total': "Sensor window summaries published",
+    }
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            # one count per bucket, then +Inf, sum
+            histogram = [0] * (len(self.BUCKETS) + 1) + [0.0]
+            self.histograms[key] = histogram
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                histogram[i] = histogram[i] + 1
+                break
+        else:
+            histogram[len(self.BUCKETS)] = histogram[len(self.BUCKETS)] + 1
+        histogram[-1] = histogram[-1] + value
+
+    def gauge(self, name, function, labels=()):
+        # function is called when the metrics are read
+        self.gauges[(name, labels)] = function
+
+    @staticmethod
+    def labels_text(labels, extra=()):
+        labels = labels + extra
+        if not labels:
+            return ''
+        return '{' + ','.join(
+            key + '="' + str(value).replace('"', '\\"') + '"'
+            for key, value in labels
+        ) + '}'
+
+    def render(self):
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# HELP ' + name + ' ' + self.HELP.get(name, ''))
+                lines.append('# TYPE ' + name + ' ' + kind)
+
+        for (name, labels), value in sorted(self.counters.items()):
+            header(name, 'counter')
+            lines.append(name + self.labels_text(labels) + ' ' + str(value))
+        for (name, labels), function in sorted(self.gauges.items()):
+            header(name, 'gauge')
+            lines.append(
+                name + self.labels_text(labels) + ' ' + str(function())
+            )
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            header(name, 'histogram')
+            cumulative = 0
+            bounds = [str(bound) for bound in self.BUCKETS] + ['+Inf']
+            for bound, count in zip(bounds, histogram):
+                cumulative = cumulative + count
+                lines.append(
+                    name + '_bucket' +
+                    self.labels_text(labels, (('le', bound),)) + ' ' +
+                    str(cumulative)
+                )
+            lines.append(
+                name + '_sum' + self.labels_text(labels) + ' ' +
+                str(histogram[-1])
+            )
+            lines.append(
+                name + '_count' + self.labels_text(labels) + ' ' +
+                str(cumulative)
+            )
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        # Compact JSON view: counters and gauges by name and labels,
+        # histograms as count and mean
+        summary = {}
+        for (name, labels), value in self.counters.items():
+            summary[name + self.labels_text(labels)] = value
+        for (name, labels), function in self.gauges.items():
+            summary[name + self.labels_text(labels)] = function()
+        for (name, labels), histogram in self.histograms.items():
+            count = sum(histogram[:-1])
+            summary[name + self.labels_text(labels)] = {
+                'count': count,
+                'mean': histogram[-1] / count if count else 0
+            }
+        return json.dumps(summary, sort_keys=True)
+
+    async def handle_http(self, reader, writer):
+        # Minimal HTTP server: any GET gets the metrics
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+            body = self.render().encode()
+            writer.write(
+                b'HTTP/1.0 200 OK\r\n'
+                b'Content-Type: text/plain; version=0.0.4\r\n'
+                b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+                b'\r\n' + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ConnectionError) as inst:
+            logging.debug("Metrics request failed: " + str(inst))
+        finally:
+            writer.close()
+
+    def serve(self, loop, host, port):
+        return loop.run_until_complete(
+            asyncio.start_server(self.handle_http, host, port)
+        )
+
+
+# Shared by every gateway of the process
+metrics = Metrics()
@@ -1,46 +1,257 @@
-import time
 import logging
 import json
+import asyncio
+from classes.DeviceRegistry import DeviceRegistry
+from classes.Metrics import metrics
+from classes.CommandQueue import CommandQueue
 
 
 class Miio:
 
-    def __init__(self, mqtt):
+    # PING/PONG carry no id, so the pending ping is kept under its method
+    PING = "internal.PING"
+    # Allowed between two JSON objects of the same datagram
+    SEPARATORS = ' \t\r\n\x00'
+    decoder = json.JSONDecoder()
+    encode = json.JSONEncoder().encode
+    # method -> bytes template, shared by all gateways
+    templates = {}
+
+    def __init__(self, mqtt, window=4, timeout=2, retries=1, name=''):
+        self.labels = (('gateway', name),)
         self.miio_id = 0
-        self.last_pong = 0
+        # smoothed round trip of the replies
+        self.srtt = None
         self.mqtt = mqtt
+        self.transport = None
+        # optional Recorder of the raw traffic
+        self.recorder = None
+        # optional RateLimiter pacing the requests
+        self.limiter = None
+        self.loop = asyncio.get_event_loop()
+        # in-flight requests: id -> entry
+        self.pending = {}
+        self.devices = DeviceRegistry()
+        self.timeout = timeout
+        self.retries = retries
+        self.slots = asyncio.Semaphore(window)
 
-    def recent_pong(self):
-        if (time.time() - self.last_pong) > 300:
-            return False
+    def next_id(self):
+        if self.miio_id != 12345:
+            self.miio_id = self.miio_id + 1
         else:
-            return True
+            self.miio_id = self.miio_id + 2
+        if self.miio_id > 999999999:
+            self.miio_id = 1
+        return self.miio_id
 
-    def msg_encode(self, data):
-        if data.get("method") and data.get("method") == "internal.PING":
-            msg = data
-        else:
-            if self.miio_id != 12345:
-                self.miio_id = self.miio_id + 1
+    def msg_template(self, data):
+        # bytes template of a command: the method is serialized once, only
+        # the id and the params are formatted per send. Commands carrying
+        # anything else than method and params are not compiled.
+        has_params = "params" in data
+        # anything else than method (and params) is never dropped
+        if len(data) != 1 + has_params or "method" not in data:
+            return None
+        method = data["method"]
+        key = (method, has_params)
+        template = self.templates.get(key)
+        if template is None:
+            if type(method) is not str:
+                return None
+            head = json.dumps({"method": method})[1:-1].encode()
+            head = head.replace(b'%', b'%%')
+            if method == self.PING:
+                template = b'{' + head + b'}'
+            elif key[1]:
+                template = b'{"id": %d, ' + head + b', "params": %s}'
             else:
-                self.miio_id = self.miio_id + 2
-            if self.miio_id > 999999999:
-                self.miio_id = 1
-            msg = {"id": self.miio_id}
+                template = b'{"id": %d, ' + head + b'}'
+            self.templates[key] = template
+        return template
+
+    def msg_encode(self, data):
+        # Same bytes as json.dumps({"id": id, **data}), PING has no id
+        template = self.msg_template(data)
+        if template is None:
+            msg = {"id": self.next_id()}
             msg.update(data)
-        return (json.dumps(msg)).encode()
+            return json.dumps(msg).encode()
+        if data["method"] == self.PING:
+            return template
+        if "params" not in data:
+            return template % self.next_id()
+        params = data["params"]
+        if type(params) is list and len(params) == 1 and \
+                type(params[0]) is int:
+            params = b'[%d]' % params[0]
+        else:
+            params = self.encode(params).encode()
+        return template % (self.next_id(), params)
 
     def msg_decode(self, data):
-        logging.debug("Received: " + data.decode())
-        if data[-1] == 0:
-            data = data[:-1]
-        res = [{""}]
-        try:
-            fixed_str = data.decode().replace('}{', '},{')
-            res = json.loads("[" + fixed_str + "]")
-        except:
-            logging.warning("Bad JSON received")
-        return res
+        # The gateway may glue several JSON objects (optionally separated
+        # by whitespace or NUL padding) into one datagram: yield them one at
+        # a time, skipping over a bad frame without losing the others
+        text = data.decode('utf-8', 'replace')
+        logging.debug("Received: %s", text)
+        decode = self.decoder.raw_decode
+        separators = self.SEPARATORS
+        pos = 0
+        end = len(text)
+        while pos < end:
+            if text[pos] in separators:
+                pos = pos + 1
+                continue
+            try:
+                miio_msg, pos = decode(text, pos)
+            except ValueError:
+                logging.warning("Bad JSON received")
+                if text[pos] == '{':
+                    pos = self.frame_end(text, pos)
+                else:
+                    # not even an object: resync on the next one
+                    pos = text.find('{', pos + 1)
+                    if pos == -1:
+                        pos = end
+                continue
+            if type(miio_msg) is dict:
+                yield miio_msg
+
+    def frame_end(self, text, start):
+        # End of the (bad) object starting with the brace at start, by
+        # brace depth outside of strings, or the next opening brace when it
+        # never closes
+        depth = 0
+        in_string = False
+        escaped = False
+        for pos in range(start, len(text)):
+            char = text[pos]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == '\\':
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char == '{':
+                depth = depth + 1
+            elif char == '}':
+                depth = depth - 1
+                if depth <= 0:
+                    return pos + 1
+        next_frame = text.find('{', start + 1)
+        if next_frame == -1:
+            return len(text)
+        return next_frame
+
+    async def acquire(self):
+        await self.slots.acquire()
+
+    def busy(self):
+        # True when the in-flight window is full
+        return self.slots.locked()
+
+    def request(self, req, states, window=True):
+        # req : topic , miio_msg, state_update
+        # window: False for a request sent without taking a slot of the
+        # in-flight window (batches)
+        data = self.msg_encode(req[1])
+        if req[1].get("method") == self.PING:
+            key = self.PING
+        else:
+            key = self.miio_id
+        if key in self.pending:
+            # previous PING still in flight, the new one supersedes it
+            self.finish(key, None)
+        future = self.loop.create_future()
+        self.pending[key] = {
+            'req': req,
+            'data': data,
+            'states': states,
+            'future': future,
+            'tries': 0,
+            'timer': None,
+            'window': window
+        }
+        self.transmit(key)
+        return future
+
+    def transmit(self, key):
+        entry = self.pending[key]
+        entry['tries'] = entry['tries'] + 1
+        entry['sent'] = self.loop.time()
+        metrics.inc('miio_requests_total', self.labels)
+        if self.limiter is not None:
+            self.limiter.take()
+        logging.debug("Sending: %s", entry['data'])
+        if self.recorder is not None:
+            self.recorder.record(self.recorder.OUT, entry['data'])
+        self.transport.sendto(entry['data'])
+        entry['timer'] = self.loop.call_later(self.timeout, self.expire, key)
+
+    def expire(self, key):
+        entry = self.pending[key]
+        if self.limiter is not None:
+            self.limiter.loss(entry['sent'])
+        # a one-shot command may have run without its reply making it
+        # back, sent twice it plays twice
+        if entry['tries'] <= self.retries and \
+                entry['req'][1].get('method') not in CommandQueue.ONESHOT:
+            logging.debug("Retrying: %s", entry['data'])
+            metrics.inc('miio_retries_total', self.labels)
+            self.transmit(key)
+            return
+        logging.warning("No reply! " + str(entry['data']))
+        metrics.inc('miio_timeouts_total', self.labels)
+        self.finish(key, None)
+
+    def finish(self, key, miio_msg):
+        entry = self.pending.pop(key)
+        entry['timer'].cancel()
+        if entry['window']:
+            self.slots.release()
+        if not entry['future'].done():
+            entry['future'].set_result(miio_msg)
+        return entry
+
+    def reply_key(self, miio_msg):
+        if miio_msg.get("method") == "internal.PONG":
+            return self.PING
+        if "result" in miio_msg or "error" in miio_msg:
+            return miio_msg.get("id")
+        return None
+
+    def handle_datagram(self, data, states):
+        if self.recorder is not None:
+            self.recorder.record(self.recorder.IN, data)
+        for miio_msg in self.msg_decode(data):
+            key = self.reply_key(miio_msg)
+            if key is not None and key in self.pending:
+                entry = self.finish(key, miio_msg)
+                rtt = self.loop.time() - entry['sent']
+                if self.srtt is None:
+                    self.srtt = rtt
+                else:
+                    self.srtt = self.srtt + (rtt - self.srtt) / 8
+                metrics.observe('miio_rtt_seconds', rtt, self.labels)
+                if self.limiter is not None:
+                    self.limiter.reply(rtt, entry['sent'])
+                if "error" in miio_msg:
+                    logging.warning(
+                        "Error reply: " + str(miio_msg.get("error"))
+                    )
+                    continue
+                self.handle_reply(
+                    entry['req'][0],
+                    miio_msg,
+                    entry['req'][2],
+                    entry['states']
+                )
+            else:
+                self.handle_msg(miio_msg, states)
 
     def msg_params(self, topic, params, states):
         for key, value in params.items():
@@ -52,28 +263,49 @@ class Miio:
                             divmod(value, 0x1000000)
                     states['light_rgb'] = \
                         states['light_rgb'] ^ states['brightness']
-                    self.mqtt.publish(
+                    self.mqtt.publish_state(
                         topic + key + "/state",
                         format(states['light_rgb'], 'x').upper()
                     )
-                    self.mqtt.publish(
+                    self.mqtt.publish_state(
                         topic + key + "/brightness/state",
                         str(states['brightness']).upper()
                     )
                 else:
-                    self.mqtt.publish(
+                    self.mqtt.publish_state(
                         topic + key + "/state",
                         str(value).upper()
                     )
             else:
                 self.msg_params(topic + key + "/", value, states)
 
+    def device_params(self, device, params, states):
+        # Flat properties of a known device go straight to its prebuilt
+        # topics, anything else takes the generic path
+        publish_state = self.mqtt.publish_state
+        for key, value in params.items():
+            if type(value) is dict or key == "rgb":
+                self.msg_params(device.sid + "/", {key: value}, states)
+            else:
+                publish_state(device.set(key, value), str(value).upper())
+
     def handle_msg(self, miio_msg, states):
         method = miio_msg.get("method", None)
+        metrics.inc(
+            'miio_events_total',
+            self.labels + (('method', str(method)),)
+        )
         topic = miio_msg.get("sid", "internal") + "/"
         params = miio_msg.get("params", None)
         if method is not None:
-            if method == "props" and "model" in miio_msg:
+            if "model" in miio_msg and "sid" in miio_msg:
+                device = self.devices.seen(miio_msg["sid"], miio_msg["model"])
+            else:
+                device = None
+            if method == "props" and device is not None:
+                if params is not None:
+                    self.device_params(device, params, states)
+            elif method == "props" and "model" in miio_msg:
                 if params is not None:
                     self.msg_params(topic, params, states)
             elif method == "props":
@@ -86,18 +318,12 @@ class Miio:
             if method.find("event.") != -1:
                 self.msg_event(topic, method, miio_msg.get("params"))
 
-    def handle_reply(self, topic, miio_msgs, state_update, states):
-        while len(miio_msgs) > 0:
-            miio_msg = miio_msgs.pop()
-            if state_update is True and miio_msg.get("result"):
-                result = miio_msg.get("result")[0].upper()
-                self.mqtt.publish(topic + "/state", result)    # publish
-                if miio_msg.get("method") and \
-                        miio_msg.get("method") == "internal.PONG":
-                    self.last_pong = time.time()
-                    logging.debug("PONG: TS updated")
-            else:
-                self.handle_msg(miio_msg, states)
+    def handle_reply(self, topic, miio_msg, state_update, states):
+        if state_update is True and miio_msg.get("result"):
+            result = str(miio_msg.get("result")[0]).upper()
+            self.mqtt.publish_state(topic + "/state", result)
+        else:
+            self.handle_msg(miio_msg, states)
 
     def msg_event(self, topic, event, params):
         value = event[6:]
@@ -36,6 +36,30 @@ class MiioMsg:
     def get_arming():
         return ["alarm", {"method": "get_arming"}, True]
 
+    def get_arming_time():
+        return [
+            "alarm/time_to_activate",
+            {"method": "get_arm_wait_time"},
+            True
+        ]
+
+    def get_volume():
+        return ["sound/volume", {"method": "get_gateway_volume"}, True]
+
+    def get_alarm_volume():
+        return [
+            "sound/alarming/volume",
+            {"method": "get_alarming_volume"},
+            True
+        ]
+
+    def get_doorbell_volume():
+        return [
+            "sound/doorbell/volume",
+            {"method": "get_doorbell_volume"},
+            True
+        ]
+
     def set_arming(state):
         if (state in ['off', 'on']):
             return [
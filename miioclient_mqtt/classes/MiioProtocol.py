@@ -0,0 +1,22 @@
+import asyncio
+import logging
+
+
+class MiioProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, on_datagram):
+        self.on_datagram = on_datagram
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.on_datagram(data)
+
+    def error_received(self, exc):
+        logging.warning("Gateway socket error: " + str(exc))
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            logging.warning("Gateway socket closed: " + str(exc))
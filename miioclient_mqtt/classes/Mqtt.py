@@ -1,20 +1,97 @@
 import logging
 import paho.mqtt.client as paho
+from classes.Metrics import metrics
 
 
 class Mqtt(paho.Client):
 
     prefix = 'x/y'
 
-    def subscribe(self, topic, qos=0):
-        topic = self.prefix + topic.lstrip('/')
+    # Topic policies, relative to the gateway prefix, first match wins:
+    # (subscription pattern, qos, retain or None to keep the caller's,
+    # critical). Critical topics are never dropped.
+    POLICY = [
+        ('alarm/#', 1, None, True),
+        ('+/alarm/state', 1, None, True),
+        ('internal/state', 1, None, True),
+        ('#', 0, None, False),
+    ]
+    # Outgoing packets paho may hold before other topics are dropped
+    max_queued = 1000
+    held = None
+    policies = None
+    will_topic = None
+
+    def subscribe(self, topic, qos=0, prefix=None):
+        topic = (prefix or self.prefix) + topic.lstrip('/')
         logging.debug("MQTT Subscribe topic: " + topic)
         return super().subscribe(topic, qos)
 
-    def publish(self, topic, payload):
-        topic = self.prefix + topic.lstrip('/')
-        logging.debug("MQTT Publish topic: " + topic + " payload: " + payload)
-        return super().publish(topic, payload)
+    def set_policy(self, policy=(), max_queued=1000, max_inflight=20):
+        # policy: list of {topic, qos, retain, critical} from the config,
+        # tried before the built-in POLICY
+        self.policy = [
+            (
+                entry['topic'],
+                entry.get('qos', 0),
+                entry.get('retain'),
+                entry.get('critical', False)
+            )
+            for entry in policy
+        ] + self.POLICY
+        self.policies = {}
+        self.max_queued = max_queued
+        self.max_inflight_messages_set(max_inflight)
+
+    def topic_policy(self, topic):
+        # Resolved once per topic
+        if self.policies is None:
+            self.set_policy()
+        policy = self.policies.get(topic)
+        if policy is None:
+            for pattern, qos, retain, critical in self.policy:
+                if paho.topic_matches_sub(pattern, topic):
+                    policy = (qos, retain, critical)
+                    break
+            self.policies[topic] = policy
+        return policy
+
+    def backlog(self):
+        # Packets queued in paho but not written to the socket yet, none
+        # when there is no paho queue behind (FakeMqtt)
+        return len(getattr(self, '_out_packet', ()))
+
+    def publish(self, topic, payload, retain=False, prefix=None):
+        # Returns False when the broker is behind and the publish dropped
+        topic = topic.lstrip('/')
+        qos, policy_retain, critical = self.topic_policy(topic)
+        if policy_retain is not None:
+            retain = policy_retain
+        topic = (prefix or self.prefix) + topic
+        if not critical and self.backlog() >= self.max_queued:
+            metrics.inc('mqtt_dropped_total', (('topic', topic),))
+            return False
+        if self.held is not None:
+            self.held.append((topic, payload, qos, retain))
+            return True
+        return self.send(topic, payload, qos, retain)
+
+    def send(self, topic, payload, qos, retain):
+        logging.debug("MQTT Publish topic: %s payload: %s", topic, payload)
+        metrics.inc('mqtt_publishes_total', (('topic', topic),))
+        return super().publish(topic, payload, qos, retain)
+
+    def hold(self):
+        # Gather publishes until flush(), e.g. those of one gateway packet
+        if self.held is None:
+            self.held = []
+
+    def flush(self):
+        held = self.held
+        self.held = None
+        if held:
+            for topic, payload, qos, retain in held:
+                self.send(topic, payload, qos, retain)
 
     def set_prefix(self, prefix):
         self.prefix = prefix.rstrip('/') + '/'
@@ -0,0 +1,44 @@
+import logging
+from classes.StateCache import StateCache
+
+
+class MqttPrefix:
+
+    # View of the shared MQTT client bound to one gateway prefix, with its
+    # own state cache so gateways never suppress each other's states
+
+    def __init__(self, mqtt, prefix):
+        self.client = mqtt
+        self.prefix = prefix.rstrip('/') + '/'
+        self.cache = StateCache()
+        self.retain = False
+
+    def subscribe(self, topic, qos=0):
+        return self.client.subscribe(topic, qos, self.prefix)
+
+    def publish(self, topic, payload, retain=False):
+        return self.client.publish(topic, payload, retain, self.prefix)
+
+    def publish_state(self, topic, payload):
+        # Only publish state topics whose value changed
+        if not self.cache.update(topic, payload):
+            return None
+        result = self.publish(topic, payload, self.retain)
+        if result is False:
+            self.cache.forget(topic)
+        return result
+
+    def hold(self):
+        self.client.hold()
+
+    def flush(self):
+        self.client.flush()
+
+    def resync(self):
+        # Republish every known state so late subscribers converge
+        logging.debug(
+            "MQTT Resync of " + self.prefix + ": " +
+            str(len(self.cache.values))
+        )
+        for topic, payload in self.cache.items():
+            self.publish(topic, payload, self.retain)
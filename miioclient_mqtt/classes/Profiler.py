@@ -0,0 +1,244 @@
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import logging
+import tempfile
+import threading
+import tracemalloc
+
+
+class Profiler:
+
+    # Profiling on demand, driven by the internal/profile topic, e.g.
+    #   {"action": "start", "mode": "cprofile", "seconds": 30,
+    #    "memory": true, "top": 20}
+    # or just start / stop. cprofile traces the event loop and the paho
+    # callbacks (Python < 3.12, see start), sample looks at the stacks of
+    # every thread each `interval` seconds. memory compares tracemalloc
+    # snapshots taken at start and stop. Stats are written to `directory`,
+    # the top entries published on internal/profile/result. Nothing is
+    # hooked while it is off.
+
+    TOPIC = 'internal/profile'
+
+    def __init__(self, loop, mqtt, directory=None, interval=0.01):
+        self.loop = loop
+        self.mqtt = mqtt
+        self.topic = mqtt.prefix + self.TOPIC
+        self.directory = directory or tempfile.gettempdir()
+        self.interval = interval
+        self.session = None
+
+    def command(self, payload):
+        # Runs in the event loop
+        try:
+            payload = payload.decode('utf-8').strip()
+            if payload.startswith('{'):
+                options = json.loads(payload)
+            else:
+                options = {'action': payload.lower()}
+            action = options.get('action', 'start')
+            if action == 'start':
+                self.start(
+                    options.get('mode', 'cprofile'),
+                    float(options.get('seconds', 30)),
+                    bool(options.get('memory', False)),
+                    int(options.get('top', 20))
+                )
+            elif action == 'stop':
+                self.stop()
+            else:
+                raise ValueError("unknown action " + action)
+        except (ValueError, TypeError, AttributeError) as inst:
+            logging.warning("Bad profile command: " + str(inst))
+
+    def start(self, mode, seconds, memory, top):
+        if self.session is not None:
+            logging.warning("Profiling already running")
+            return
+        if mode not in ('cprofile', 'sample'):
+            raise ValueError("unknown mode " + mode)
+        requested = mode
+        if mode == 'cprofile' and sys.version_info >= (3, 12):
+            # cProfile sits on sys.monitoring there, which takes a single
+            # profiler per interpreter: the paho thread could not have its
+            # own, and the error would kill it
+            logging.warning("cprofile needs Python < 3.12, sampling")
+            mode = 'sample'
+        session = {
+            'mode': mode,
+            'requested': requested,
+            'top': top,
+            'started': time.time(),
+            'snapshot': None,
+            'tracing': False,
+        }
+        if mode == 'cprofile':
+            # one profile per thread, the paho one only around callbacks
+            session['profiles'] = [cProfile.Profile(), cProfile.Profile()]
+            # fails when another profiler is active
+            session['profiles'][0].enable()
+            session['on_message'] = self.mqtt.on_message
+            session['on_connect'] = self.mqtt.on_connect
+            self.mqtt.on_message = self.wrap(
+                session['on_message'], session['profiles'][1]
+            )
+            self.mqtt.on_connect = self.wrap(
+                session['on_connect'], session['profiles'][1]
+            )
+        else:
+            session['samples'] = {}
+            session['sampling'] = threading.Event()
+            session['thread'] = threading.Thread(
+                target=self.sample,
+                args=(session['samples'], session['sampling']),
+                daemon=True
+            )
+            session['thread'].start()
+        if memory:
+            session['tracing'] = not tracemalloc.is_tracing()
+            if session['tracing']:
+                tracemalloc.start()
+            session['snapshot'] = tracemalloc.take_snapshot()
+        session['timer'] = self.loop.call_later(seconds, self.stop)
+        self.session = session
+        logging.info("Profiling (" + mode + ") for " + str(seconds) + " s")
+
+    def wrap(self, callback, profile):
+        def profiled(*args):
+            return profile.runcall(callback, *args)
+        return profiled
+
+    def sample(self, samples, sampling):
+        # Runs in its own thread: collapsed stacks -> count
+        own = threading.get_ident()
+        while not sampling.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        code.co_name + ' (' +
+                        os.path.basename(code.co_filename) + ':' +
+                        str(code.co_firstlineno) + ')'
+                    )
+                    frame = frame.f_back
+                stack = ';'.join(reversed(stack))
+                samples[stack] = samples.get(stack, 0) + 1
+
+    def stop(self):
+        session = self.session
+        if session is None:
+            return
+        self.session = None
+        session['timer'].cancel()
+        name = os.path.join(
+            self.directory,
+            time.strftime(
+                'miioclient-profile-%Y%m%d-%H%M%S',
+                time.localtime(session['started'])
+            )
+        )
+        result = {
+            'mode': session['mode'],
+            'seconds': round(time.time() - session['started'], 1),
+        }
+        if session['requested'] != session['mode']:
+            result['requested'] = session['requested']
+        # first of all, whatever fails below, leave nothing hooked behind
+        if session['mode'] == 'cprofile':
+            self.unhook(session)
+        else:
+            session['sampling'].set()
+        try:
+            if session['mode'] == 'cprofile':
+                result['file'] = name + '.pstats'
+                result['top'] = self.profile_top(
+                    session['profiles'], session['top'], result['file']
+                )
+            else:
+                session['thread'].join()
+                result['file'] = name + '.collapsed'
+                result['top'] = self.sample_top(
+                    session['samples'], session['top'], result['file']
+                )
+            if session['snapshot'] is not None:
+                snapshot = tracemalloc.take_snapshot()
+                result['memory_file'] = name + '.tracemalloc'
+                snapshot.dump(result['memory_file'])
+                result['memory'] = [
+                    {
+                        'where': str(stat.traceback),
+                        'size_diff': stat.size_diff,
+                        'count_diff': stat.count_diff,
+                    }
+                    for stat in snapshot.compare_to(
+                        session['snapshot'], 'lineno'
+                    )[:session['top']]
+                ]
+        except (OSError, ValueError, TypeError) as inst:
+            result['error'] = str(inst)
+        finally:
+            if session['tracing']:
+                tracemalloc.stop()
+        logging.info("Profiling done: " + result.get('file', ''))
+        self.mqtt.publish(self.TOPIC + '/result', json.dumps(result))
+
+    def unhook(self, session):
+        session['profiles'][0].disable()
+        self.mqtt.on_message = session['on_message']
+        self.mqtt.on_connect = session['on_connect']
+
+    def profile_top(self, profiles, top, path):
+        # pstats refuses a profile that saw nothing, as the callback one
+        # on an idle bridge
+        profiles = [profile for profile in profiles if profile.getstats()]
+        if not profiles:
+            raise ValueError("nothing profiled")
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(path)
+        entries = sorted(
+            stats.stats.items(),
+            key=lambda item: item[1][2],
+            reverse=True
+        )
+        return [
+            {
+                'function': pstats.func_std_string(function),
+                'calls': calls,
+                'tottime': round(tottime, 6),
+                'cumtime': round(cumtime, 6),
+            }
+            for function, (primitive, calls, tottime, cumtime, callers)
+            in entries[:top]
+        ]
+
+    def sample_top(self, samples, top, path):
+        # Collapsed stacks, as flamegraph.pl reads them
+        with open(path, 'w') as file:
+            for stack, count in samples.items():
+                file.write(stack + ' ' + str(count) + '\n')
+        # samples where the function was running / on the stack
+        own = {}
+        total = {}
+        for stack, count in samples.items():
+            functions = stack.split(';')
+            own[functions[-1]] = own.get(functions[-1], 0) + count
+            for function in set(functions):
+                total[function] = total.get(function, 0) + count
+        entries = sorted(own.items(), key=lambda item: item[1], reverse=True)
+        return [
+            {
+                'function': function,
+                'samples': count,
+                'total_samples': total[function],
+            }
+            for function, count in entries[:top]
+        ]
@@ -0,0 +1,74 @@
+import asyncio
+
+
+class RateLimiter:
+
+    # Token bucket pacing the requests sent to a gateway, at a rate found
+    # by AIMD: every reply adds increase / rate (so about `increase`
+    # requests per second each second at full speed), a lost request or a
+    # reply slower than the fastest seen plus `delay` divides it by
+    # 1 / decrease, once per congestion event. The rate settles just
+    # below what the gateway can take instead of filling its buffers until
+    # it drops commands.
+
+    def __init__(self, loop, rate=20, minimum=1, maximum=200, burst=10,
+                 increase=10, decrease=0.5, delay=0.25):
+        self.loop = loop
+        self.rate = rate
+        self.minimum = minimum
+        self.maximum = maximum
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.delay = delay
+        self.tokens = burst
+        self.updated = loop.time()
+        # fastest reply seen, the gateway with nothing queued
+        self.min_rtt = None
+        self.last_cut = 0
+        self.cuts = 0
+
+    def refill(self):
+        now = self.loop.time()
+        self.tokens = min(
+            self.burst,
+            self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    async def wait(self):
+        # Until a request may go, the token is taken when it does
+        self.refill()
+        while self.tokens < 1:
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+            self.refill()
+
+    def take(self):
+        # Retries and batches are not held back, the next requests pay
+        self.refill()
+        self.tokens = max(-self.burst, self.tokens - 1)
+
+    def reply(self, rtt, sent):
+        # sent: when the request answered was (last) sent
+        if self.min_rtt is None or rtt < self.min_rtt:
+            self.min_rtt = rtt
+        if rtt > self.min_rtt + self.delay:
+            self.cut(sent)
+        else:
+            self.rate = min(
+                self.maximum,
+                self.rate + self.increase / self.rate
+            )
+
+    def loss(self, sent):
+        self.cut(sent)
+
+    def cut(self, sent):
+        # One congestion event usually costs several requests: only those
+        # sent after the previous cut may cut again
+        if sent <= self.last_cut:
+            return
+        self.refill()
+        self.last_cut = self.loop.time()
+        self.cuts = self.cuts + 1
+        self.rate = max(self.minimum, self.rate * self.decrease)
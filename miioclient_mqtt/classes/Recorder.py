@@ -0,0 +1,67 @@
+import os
+import mmap
+import time
+import struct
+import logging
+
+
+class Recorder:
+
+    # Append-only log of the raw UDP traffic of one gateway. The file starts
+    # with MAGIC, then one record per datagram: a fixed HEADER (wall clock
+    # timestamp, direction, length) followed by the datagram bytes as they
+    # were on the wire.
+
+    MAGIC = b'MIIOREC1'
+    HEADER = struct.Struct('<dBI')
+    IN = 0
+    OUT = 1
+
+    def __init__(self, path, flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(self.MAGIC)
+        self.flushed = time.monotonic()
+        self.records = 0
+
+    def record(self, direction, data):
+        self.file.write(self.HEADER.pack(time.time(), direction, len(data)))
+        self.file.write(data)
+        self.records = self.records + 1
+        # buffered, but never more than flush_interval behind
+        now = time.monotonic()
+        if now - self.flushed > self.flush_interval:
+            self.file.flush()
+            self.flushed = now
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+            logging.debug(
+                "Recorded " + str(self.records) + " datagrams to " + self.path
+            )
+
+    @classmethod
+    def read(cls, path):
+        # Yields (timestamp, direction, data) from a recording. A record cut
+        # short by a crash ends the iteration.
+        with open(path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size <= len(cls.MAGIC):
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if data[:len(cls.MAGIC)] != cls.MAGIC:
+                    raise ValueError(path + " is not a gateway recording")
+                pos = len(cls.MAGIC)
+                end = len(data)
+                size = cls.HEADER.size
+                while pos + size <= end:
+                    timestamp, direction, length = \
+                        cls.HEADER.unpack_from(data, pos)
+                    pos = pos + size
+                    if pos + length > end:
+                        logging.warning("Truncated record in " + path)
+                        return
+                    yield timestamp, direction, data[pos:pos + length]
+                    pos = pos + length
@@ -0,0 +1,61 @@
+import logging
+
+
+class Router:
+
+    # Declarative MQTT topic table, compiled once into dicts:
+    #   (pattern, handler, parser)
+    # pattern is a topic relative to the gateway prefix, or "first/#" to
+    # catch a whole subtree, in which case the handler also gets the rest
+    # of the topic. Lookup is a dict access, unknown topics are rejected
+    # before their payload is even decoded.
+
+    def __init__(self, routes):
+        self.exact = {}
+        self.subtrees = {}
+        for pattern, handler, parser in routes:
+            if pattern.endswith('/#'):
+                self.subtrees[pattern[:-2]] = (handler, parser, True)
+            else:
+                self.exact[pattern] = (handler, parser, False)
+
+    def match(self, topic):
+        route = self.exact.get(topic)
+        if route is None:
+            route = self.subtrees.get(topic.split('/', 1)[0])
+            if route is not None and '/' not in topic:
+                return None
+        return route
+
+    def dispatch(self, route, topic, raw_payload):
+        handler, parser, subtree = route
+        try:
+            payload = raw_payload.decode("utf-8")
+            logging.debug(
+                "MQTT Received topic: " + topic + " payload: " + payload
+            )
+            value = parser(payload)
+            if subtree:
+                handler(topic.split('/', 1)[1], value)
+            else:
+                handler(value)
+        except (ValueError, KeyError, IndexError, TypeError) as inst:
+            logging.warning("Bad command on " + topic + ": " + str(inst))
+
+    # Payload parsers
+
+    @staticmethod
+    def text(payload):
+        return payload
+
+    @staticmethod
+    def lower(payload):
+        return payload.strip().lower()
+
+    @staticmethod
+    def integer(payload):
+        return int(payload)
+
+    @staticmethod
+    def hexadecimal(payload):
+        return int(payload, 16)
@@ -0,0 +1,39 @@
+import os
+import json
+import logging
+
+
+class Snapshot:
+
+    # JSON file holding what a gateway needs to warm start. It is written to
+    # a temporary file first and renamed over the previous one, so a crash
+    # or a full disk never leaves a half written snapshot behind.
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as inst:
+            logging.warning(
+                "Ignoring snapshot " + self.path + ": " + str(inst)
+            )
+            return {}
+        if type(data) is not dict:
+            return {}
+        return data
+
+    def save(self, data):
+        temporary = self.path + '.tmp'
+        try:
+            with open(temporary, 'w') as file:
+                json.dump(data, file, sort_keys=True)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary, self.path)
+        except OSError as inst:
+            logging.warning("Snapshot not saved: " + str(inst))
@@ -0,0 +1,29 @@
+import time
+
+
+class StateCache:
+
+    # Last value published on each state topic (relative to the prefix)
+
+    def __init__(self):
+        self.values = {}
+        self.updated = {}
+
+    def update(self, topic, payload):
+        # Returns True when the value differs from the cached one
+        if self.values.get(topic) == payload:
+            return False
+        self.values[topic] = payload
+        self.updated[topic] = time.time()
+        return True
+
+    def get(self, topic, default=None):
+        return self.values.get(topic, default)
+
+    def items(self):
+        return list(self.values.items())
+
+    def forget(self, topic):
+        # The value never made it out, publish it again next time
+        self.values.pop(topic, None)
+        self.updated.pop(topic, None)
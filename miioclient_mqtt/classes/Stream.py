@@ -0,0 +1,133 @@
+from classes.Metrics import metrics
+
+
+class Stream:
+
+    # Values of one topic on their way to MQTT, under a StreamFilter rule:
+    # debounced (published once stable for `debounce` seconds), rate
+    # limited (at most one publish per `rate` seconds, the latest held value
+    # goes out at the end of the interval) and summarized over tumbling
+    # windows of `window` seconds on the min/max/avg/count sibling topics.
+
+    __slots__ = (
+        'filter', 'topic', 'base', 'publish', 'debounce', 'rate', 'window',
+        'settling', 'settle_timer', 'held', 'holding', 'last_sent',
+        'rate_timer', 'count', 'numbers', 'total', 'minimum', 'maximum',
+        'window_timer'
+    )
+
+    def __init__(self, filter, topic, publish, debounce, rate, window):
+        self.filter = filter
+        self.topic = topic
+        if topic.endswith('/state'):
+            self.base = topic[:-len('state')]
+        else:
+            self.base = topic + '/'
+        # publish_state or publish of the MqttPrefix
+        self.publish = publish
+        self.debounce = debounce
+        self.rate = rate
+        self.window = window
+        self.settling = None
+        self.settle_timer = None
+        self.held = None
+        self.holding = False
+        self.last_sent = None
+        self.rate_timer = None
+        self.count = 0
+        self.numbers = 0
+        self.total = 0
+        self.minimum = None
+        self.maximum = None
+        self.window_timer = None
+
+    def push(self, payload):
+        if self.window:
+            self.sample(payload)
+        if not self.debounce:
+            self.offer(payload)
+            return
+        if self.settle_timer is not None:
+            self.settle_timer.cancel()
+            self.filter.suppressed()
+        self.settling = payload
+        self.settle_timer = self.filter.loop.call_later(
+            self.debounce,
+            self.settled
+        )
+
+    def settled(self):
+        self.settle_timer = None
+        self.offer(self.settling)
+
+    def offer(self, payload):
+        if not self.rate:
+            self.publish(self.topic, payload)
+            return
+        now = self.filter.loop.time()
+        if self.rate_timer is None and (
+            self.last_sent is None or now - self.last_sent >= self.rate
+        ):
+            self.last_sent = now
+            self.publish(self.topic, payload)
+            return
+        if self.holding:
+            self.filter.suppressed()
+        self.held = payload
+        self.holding = True
+        if self.rate_timer is None:
+            self.rate_timer = self.filter.loop.call_at(
+                self.last_sent + self.rate,
+                self.release
+            )
+
+    def release(self):
+        self.rate_timer = None
+        if self.holding:
+            self.holding = False
+            self.last_sent = self.filter.loop.time()
+            self.publish(self.topic, self.held)
+
+    def sample(self, payload):
+        # Numbers feed min/max/avg, anything else is only counted
+        self.count = self.count + 1
+        try:
+            value = float(payload)
+        except ValueError:
+            value = None
+        if value is not None:
+            self.numbers = self.numbers + 1
+            self.total = self.total + value
+            if self.minimum is None or value < self.minimum:
+                self.minimum = value
+            if self.maximum is None or value > self.maximum:
+                self.maximum = value
+        if self.window_timer is None:
+            self.window_timer = self.filter.loop.call_later(
+                self.window,
+                self.close_window
+            )
+
+    def close_window(self):
+        # The next window opens with the next sample
+        self.window_timer = None
+        mqtt = self.filter.mqtt
+        if self.minimum is not None:
+            mqtt.publish(self.base + 'min', '%g' % self.minimum)
+            mqtt.publish(self.base + 'max', '%g' % self.maximum)
+            mqtt.publish(
+                self.base + 'avg',
+                '%g' % (self.total / self.numbers)
+            )
+        mqtt.publish(self.base + 'count', str(self.count))
+        metrics.inc('stream_windows_total', self.filter.labels)
+        self.count = 0
+        self.numbers = 0
+        self.total = 0
+        self.minimum = None
+        self.maximum = None
+
+    def close(self):
+        for timer in (self.settle_timer, self.rate_timer, self.window_timer):
+            if timer is not None:
+                timer.cancel()
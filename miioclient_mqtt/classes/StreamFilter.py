@@ -0,0 +1,69 @@
+import paho.mqtt.client as paho
+from classes.Metrics import metrics
+from classes.Stream import Stream
+
+
+class StreamFilter:
+
+    # Stands between Miio and the MqttPrefix of a gateway: values of topics
+    # matching a rule go through a Stream (one per topic, so per sid and per
+    # property), the others are published right away. Rules are tried in
+    # order, the critical topics first, so alarms are never held back.
+    CRITICAL = ['alarm/#', '+/alarm/state']
+
+    def __init__(self, mqtt, loop, rules, name=''):
+        self.mqtt = mqtt
+        self.loop = loop
+        self.labels = (('gateway', name),)
+        # (pattern, debounce, rate, window) or (pattern, None) to pass
+        self.rules = [(pattern, None) for pattern in self.CRITICAL] + [
+            (
+                rule['topic'],
+                None if rule.get('passthrough') else (
+                    rule.get('debounce', 0),
+                    rule.get('rate', 0),
+                    rule.get('window', 0)
+                )
+            )
+            for rule in rules
+        ]
+        # topic -> Stream, or None when published right away
+        self.streams = {}
+
+    def stream(self, topic, publish):
+        # Resolved once per topic
+        for pattern, rule in self.rules:
+            if paho.topic_matches_sub(pattern, topic):
+                break
+        else:
+            rule = None
+        if rule is not None:
+            rule = Stream(self, topic, publish, *rule)
+        self.streams[topic] = rule
+        return rule
+
+    def publish_state(self, topic, payload):
+        try:
+            stream = self.streams[topic]
+        except KeyError:
+            stream = self.stream(topic, self.mqtt.publish_state)
+        if stream is None:
+            return self.mqtt.publish_state(topic, payload)
+        stream.push(payload)
+
+    def publish(self, topic, payload, retain=False):
+        try:
+            stream = self.streams[topic]
+        except KeyError:
+            stream = self.stream(topic, self.mqtt.publish)
+        if stream is None or retain:
+            return self.mqtt.publish(topic, payload, retain)
+        stream.push(payload)
+
+    def suppressed(self):
+        metrics.inc('stream_suppressed_total', self.labels)
+
+    def close(self):
+        for stream in self.streams.values():
+            if stream is not None:
+                stream.close()
@@ -6,20 +6,14 @@
 # IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
 # FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
 
-import time
-import socket
 import os
 import yaml
-from multiprocessing import Queue
+import asyncio
 import logging
-from classes.Miio import Miio
-from classes.MiioMsg import MiioMsg
+from classes.Gateway import Gateway
+from classes.Metrics import metrics
 from classes.Mqtt import Mqtt
-
-# Constants
-miio_len_max = 1480
-
-queue = Queue(maxsize=100)
+from classes.Profiler import Profiler
 
 
 def read_config():
@@ -29,67 +23,64 @@ def read_config():
     return config
 
 
-def initial_states(config):
-    return {
-        'sound':
-            config.get('initial_states', {}).get('sound', 2),
-        'sound_volume':
-            config.get('initial_states', {}).get('sound_volume', 50),
-        'light_rgb':
-            int(
-                config.get('initial_states', {}).get('light_rgb', 'ffffff'),
-                16
-            ),
-        'doorbell_volume':
-            config.get('initial_states', {}).get('doorbell_volume', 25),
-        'doorbell_sound':
-            config.get('initial_states', {}).get('doorbell_sound', 11),
-        'alarm_volume':
-            config.get('initial_states', {}).get('alarm_volume', 90),
-        'alarm_sound':
-            config.get('initial_states', {}).get('alarm_sound', 2),
-        'arming_time':
-            config.get('initial_states', {}).get('arming_time', 30),
-        'alarm_duration':
-            config.get('initial_states', {}).get('alarm_duration', 1200),
-        'brightness':
-            config.get('initial_states', {}).get('brightness', 54),
+def gateway_configs(config):
+    # Either a list of gateways, or the single miio entry of older configs.
+    # Settings missing from a gateway entry are taken from the top level.
+    defaults = {
+        'prefix': config['mqtt']['prefix'],
+        'retain': config['mqtt'].get('retain', False),
+        'silent_start': config.get('silent_start', False),
+        'initial_states': config.get('initial_states', {}),
+        'effects': config.get('effects', {}),
     }
-
-
-def queueAppend(queue, item):
-    if (item):
-        queue.put(item)
-        return True
-    else:
-        return False
+    defaults.update(config.get('miio', {}))
+    gateways = []
+    for gateway in config.get('gateways', [{}]):
+        gateway_config = dict(defaults)
+        gateway_config.update(gateway)
+        gateway_config['initial_states'] = dict(defaults['initial_states'])
+        gateway_config['initial_states'].update(
+            gateway.get('initial_states', {})
+        )
+        gateways.append(gateway_config)
+    # Commands are routed by prefix, a shared one would starve a gateway
+    prefixes = [
+        gateway_config['prefix'].rstrip('/') + '/'
+        for gateway_config in gateways
+    ]
+    for prefix in set(prefixes):
+        if prefixes.count(prefix) > 1:
+            raise ValueError(
+                "Several gateways use the MQTT prefix " + prefix +
+                ", give each one its own prefix"
+            )
+    return gateways
 
 
 def mqtt_connect(client, userdata, flags, rc):
     try:
         logging.debug("MQTT Connected with result code "+str(rc))
-        # Subscribe to default MQTT topics for the gateway
-        userdata['mqtt'].subscribe("heartbeat")
-        userdata['mqtt'].subscribe("alarm")
-        userdata['mqtt'].subscribe("alarm/time_to_activate")
-        userdata['mqtt'].subscribe("alarm/duration")
-        userdata['mqtt'].subscribe("light")
-        userdata['mqtt'].subscribe("brightness")
-        userdata['mqtt'].subscribe("rgb")
-        userdata['mqtt'].subscribe("sound")
-        userdata['mqtt'].subscribe("sound/sound")
-        userdata['mqtt'].subscribe("sound/volume")
-        userdata['mqtt'].subscribe("sound/alarming/volume")
-        userdata['mqtt'].subscribe("sound/alarming/sound")
-        userdata['mqtt'].subscribe("sound/doorbell/volume")
-        userdata['mqtt'].subscribe("sound/doorbell/sound")
-        userdata['mqtt'].subscribe('effect/blink')
-        userdata['mqtt'].subscribe('effect/slowblink')
+        for gateway in userdata['gateways']:
+            # One wildcard subscription per gateway, topics are routed by
+            # Gateway.router
+            gateway.mqtt.subscribe("#")
+            # Retained states may be gone with a broker restart
+            gateway.loop.call_soon_threadsafe(gateway.liveness.announce)
+        if client.will_topic is not None and not any(
+            gateway.mqtt.prefix + 'internal/state' == client.will_topic
+            for gateway in userdata['gateways']
+        ):
+            # Will of the bridge itself, not shared with a gateway state
+            client.publish(
+                client.will_topic[len(client.prefix):], 'ONLINE', True
+            )
+        if userdata.get('profiler') is not None:
+            client.subscribe(Profiler.TOPIC)
     except Exception as inst:
         logging.debug("Exception: " + inst.args)
 
 
-def mqtt_init(config):
+def mqtt_init(config, loop):
     mqtt = Mqtt()
     mqtt.username_pw_set(
         config.get('mqtt', {}).get('username', ''),
@@ -97,278 +88,137 @@ def mqtt_init(config):
     )
     mqtt.on_connect = mqtt_connect
     mqtt.on_message = mqtt_message
-    mqtt.connect(config['mqtt']['broker'])
+    mqtt.set_policy(
+        config['mqtt'].get('policy', []),
+        config['mqtt'].get('max_queued', 1000),
+        config['mqtt'].get('max_inflight', 20)
+    )
     mqtt.set_prefix(config['mqtt']['prefix'])
-    mqtt.user_data_set({'prefix': config['mqtt']['prefix'], 'mqtt': mqtt})
-    mqtt.loop_start()
+    # The broker reports the bridge (or, with the default topic and a
+    # single gateway, the gateway) OFFLINE if the connection drops
+    will_topic = config['mqtt'].get('will_topic', 'internal/state')
+    if will_topic:
+        mqtt.will_topic = mqtt.prefix + will_topic.lstrip('/')
+        mqtt.will_set(mqtt.will_topic, 'OFFLINE', 1, True)
+    mqtt.connect(config['mqtt']['broker'])
     return mqtt
 
 
-# MQTT callback
+# MQTT callback, runs in the paho network thread: unknown topics (including
+# our own state publishes) are dropped right here, the others are handed over
+# to the event loop so states and queues are only ever touched from one thread
 def mqtt_message(client, userdata, message):
-
-    try:
-        topic = message.topic[len(userdata['prefix']):]
-        payload = message.payload.decode("utf-8")
-        logging.debug(
-            "MQTT Received topic: " + topic + " payload: " + str(payload)
+    profiler = userdata.get('profiler')
+    if profiler is not None and message.topic == profiler.topic:
+        userdata['loop'].call_soon_threadsafe(
+            profiler.command,
+            message.payload
         )
-        command = str(message.payload.decode("utf-8"))
-        if topic == "heartbeat":
-            queueAppend(queue, MiioMsg.get_arming())
-        if topic == "alarm":
-            queueAppend(queue, MiioMsg.set_arming(command.lower()))
-        if topic == "light":
-            queueAppend(queue, MiioMsg.set_light(command.lower()))
-        if topic == "brightness":
-            if (queueAppend(
-                queue,
-                MiioMsg.set_rgb(command, states['light_rgb'])
-            )):
-                states['brightness'] = command
-        if topic == "rgb":
-            if (queueAppend(
-                queue,
-                MiioMsg.set_rgb(states['brightness'], int(command, 16))
-            )):
-                states['light_rgb'] = int(command, 16)
-        if topic == "sound/volume":
-            if (queueAppend(queue, MiioMsg.set_volume(command))):
-                states['sound_volume'] = command
-        if topic == "sound":
-            if command.lower() == "on":
-                queueAppend(
-                    queue,
-                    MiioMsg.play_sound(states['sound'], states['sound_volume'])
-                )
-            if command.upper() == "OFF":
-                queueAppend(queue, MiioMsg.stop_sound())
-        if topic == "sound/sound":
-            states['sound'] = int(command)
-        if topic == "sound/alarming/volume":
-            if (queueAppend(queue, MiioMsg.set_alarm_volume(queue))):
-                states['alarm_volume'] = command
-        if topic == "sound/alarming/sound":
-            if (queueAppend(queue, MiioMsg.set_alarm_sound(command))):
-                states['alarm_sound'] = command
-        if topic == "sound/doorbell/volume":
-            if (queueAppend(queue, MiioMsg.set_doorbell_volume(command))):
-                states['doorbell_volume'] = command
-        if topic == "sound/doorbell/sound":
-            if (queueAppend(queue, MiioMsg.set_doorbell_sound(command))):
-                states['doorbell_sound'] = command
-        if topic == "effect/blink":
-            # color:color:duration
-            command_parts = command.split(':', 3)
-            # states['effect']['flag'] = 1
-            states['effect'] = {}
-            states['effect']['type'] = 'blink'
-            if int(command_parts[0], 16) > 0xffffff:
-                (
-                    states['effect']['start_brightness'],
-                    states['effect']['start_color']
-                ) = divmod(int(command_parts[0], 16), 0x1000000)
-            else:
-                states['effect']['start_brightness'] = states['brightness']
-                states['effect']['start_color'] = int(command_parts[0], 16)
-            if int(command_parts[1], 16) > 0xffffff:
-                (
-                    states['effect']['target_brightness'],
-                    states['effect']['target_color']
-                ) = divmod(int(command_parts[1], 16), 0x1000000)
-            else:
-                states['effect']['target_brightness'] = states['brightness']
-                states['effect']['target_color'] = int(command_parts[1], 16)
-            states['effect']['current_color'] = states['effect']['start_color']
-            states['effect']['end_time'] = time.time() + int(command_parts[2])
-            states['effect']['active'] = True
-            states['effect']['last_iteration'] = time.time()
-            queueAppend(queue, MiioMsg.set_light('on'))
-            queueAppend(
-                queue,
-                MiioMsg.set_rgb(
-                    states['effect']['start_brightness'],
-                    states['effect']['start_color']
+        return
+    for gateway in userdata['gateways']:
+        if message.topic.startswith(gateway.mqtt.prefix):
+            topic = message.topic[len(gateway.mqtt.prefix):]
+            route = gateway.router.match(topic)
+            if route is not None:
+                userdata['loop'].call_soon_threadsafe(
+                    gateway.router.dispatch,
+                    route,
+                    topic,
+                    message.payload
                 )
+            return
+
+
+def gateways_init(config, mqtt, loop, profiler=None):
+    gateways = [
+        Gateway(gateway_config, mqtt, loop)
+        for gateway_config in gateway_configs(config)
+    ]
+    # Longest prefix first, so nested prefixes reach the right gateway
+    gateways.sort(key=lambda gateway: len(gateway.mqtt.prefix), reverse=True)
+    mqtt.user_data_set({
+        'mqtt': mqtt,
+        'loop': loop,
+        'gateways': gateways,
+        'profiler': profiler
+    })
+    return gateways
+
+
+def gateways_start(gateways, loop):
+    for gateway in gateways:
+        try:
+            loop.run_until_complete(gateway.start())
+        except OSError as inst:
+            # Keep serving the other gateways
+            logging.error(
+                "Gateway " + str(gateway.address) + " not started: " +
+                str(inst)
             )
-        if topic == "effect/slowblink":
-            # color:pulse:duration
-            command_parts = command.split(':', 3)
-            # states['effect']['flag'] = 1
-            states['effect'] = {}
-            states['effect']['type'] = 'slowblink'
-            states['effect']['start_color'] = int('000000', 16)
-            states['effect']['target_color'] = int(command_parts[0], 16)
-            states['effect']['pulse_time'] = int(command_parts[1])
-            states['effect']['pulse_start'] = time.time()
-            states['effect']['pulse_end'] = time.time() + int(command_parts[1])
-            states['effect']['end_time'] = time.time() + int(command_parts[2])
-            states['effect']['last_iteration'] = time.time()
-    except Exception as inst:
-        logging.debug("Exception: " + inst.args)
-
-
-def time_to_color(t0, t1, tx, c0, c1):
-    if tx >= t1:
-        return c1
-    else:
-        a = (c0 - c1) / (t0 - t1)
-        b = c1 - t1 * ((c0 - c1) / (t0 - t1))
-        return int(a * tx + b)
-
 
-def handle_effect():
-    if (states.get('effect', {}).get('end_time', 0) < time.time()):
-        states['effect']['active'] = False
-        queueAppend(queue, MiioMsg.set_light('off'))
-        return
 
-    if states['effect']['type'] == 'slowblink':
-        slowblink()
-    elif states['effect']['type'] == 'blink':
-        blink()
-    else:
-        logging.debug("Unknown effect: " + states['effect']['type'])
+def resync(loop, gateways, interval):
+    for gateway in gateways:
+        gateway.mqtt.resync()
+    loop.call_later(interval, resync, loop, gateways, interval)
 
 
-def blink():
-    if (states['effect']['last_iteration'] + 0.5 > time.time()):
-        return
-    else:
-        states['effect']['last_iteration'] = time.time()
-    if states['effect']['current_color'] == states['effect']['start_color']:
-        states['light_rgb'] = states['effect']['target_color']
-        states['brightness'] = states['effect']['target_brightness']
-    else:
-        states['light_rgb'] = states['effect']['start_color']
-        states['brightness'] = states['effect']['start_brightness']
-    states['effect']['current_color'] = states['light_rgb']
-    queueAppend(
-        queue,
-        MiioMsg.set_rgb(states['brightness'], states['light_rgb'])
-    )
+def publish_metrics(loop, mqtt, interval):
+    mqtt.publish('internal/metrics', metrics.summary())
+    loop.call_later(interval, publish_metrics, loop, mqtt, interval)
 
 
-def slowblink():
-    if (states['effect']['last_iteration'] + 0.5 > time.time()):
-        return
-    else:
-        states['effect']['last_iteration'] = time.time()
-    tx = time.time()
-    cx_red = time_to_color(
-            states['effect']['pulse_start'],
-            states['effect']['pulse_end'],
-            tx,
-            states['effect']['start_color'] // 0x10000 % 0x100,
-            states['effect']['target_color'] // 0x10000 % 0x100
-    )
-    cx_green = time_to_color(
-            states['effect']['pulse_start'],
-            states['effect']['pulse_end'],
-            tx,
-            states['effect']['start_color'] // 0x100 % 0x100,
-            states['effect']['target_color'] // 0x100 % 0x100
-    )
-    cx_blue = time_to_color(
-            states['effect']['pulse_start'],
-            states['effect']['pulse_end'],
-            tx,
-            states['effect']['start_color'] // 1 % 0x100,
-            states['effect']['target_color'] // 1 % 0x100
+def main():
+    config = read_config()
+    logging.basicConfig(
+        level=config.get('log_level', 'NOTSET'),
+        format='%(asctime)s - %(message)s'
     )
-    brightness = time_to_color(
-        states['effect']['pulse_start'],
-        states['effect']['pulse_end'],
-        tx,
-        0,
-        100
-    )
-
-    print(str(cx_red) + "/" + str(cx_green) + "/" + str(cx_blue))
-    if tx >= states['effect']['pulse_end']:
-        states['effect']['pulse_start'] = time.time()
-        states['effect']['pulse_end'] = \
-            time.time() + states['effect']['pulse_time']
-    cx = cx_red * 0x10000 + cx_green * 0x100 + cx_blue
-    print("Effect color: " + format(int(cx), 'x'))
-    queueAppend(
-        queue,
-        MiioMsg.set_rgb(brightness, int(cx))
-    )
-
-
-config = read_config()
-logging.basicConfig(
-    level=config.get('log_level', 'NOTSET'),
-    format='%(asctime)s - %(message)s'
-)
-states = initial_states(config)
-mqtt = mqtt_init(config)
-miio = Miio(mqtt)
-
-# Create a UDP socket at client side
-UDPClientSocket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
-UDPClientSocket.settimeout(1)
-# Send a PING first
-queueAppend(queue, MiioMsg.ping())
-ts_last_ping = time.time()
-# Is Gateway armed?
-queueAppend(queue, MiioMsg.get_arming())
-# Set time in seconds after which alarm is really armed
-queueAppend(queue, MiioMsg.set_arming_time(states['arming_time']))
-if (not config['silent_start']):
-    # Set duration of alarm if triggered
-    queueAppend(queue, MiioMsg.set_alarm_duration(states['alarm_duration']))
-    queueAppend(queue, MiioMsg.set_alarm_volume(states['alarm_volume']))
-    queueAppend(queue, MiioMsg.set_alarm_sound(states['alarm_sound']))
-    queueAppend(queue, MiioMsg.set_doorbell_volume(states['doorbell_volume']))
-    queueAppend(queue, MiioMsg.set_doorbell_sound(states['doorbell_sound']))
-    # Turn OFF sound as previous commands will make the gateway play tones
-    queueAppend(queue, MiioMsg.stop_sound())
-# Set intensity + color
-queueAppend(queue, MiioMsg.set_rgb(states['brightness'], states['light_rgb']))
-
-while True:
-    while not queue.empty():
-        # print("Something in the queue")
-        # req : topic , miio_msg
-        req = queue.get()
-        logging.debug("Sending: " + str(miio.msg_encode(req[1])))
-        UDPClientSocket.sendto(
-            miio.msg_encode(req[1]),
-            (config['miio']['broker'], config['miio']['port'])
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    mqtt = mqtt_init(config, loop)
+    profiler = None
+    profile_config = config.get('profile', {})
+    if profile_config is not False:
+        profiler = Profiler(
+            loop,
+            mqtt,
+            profile_config.get('directory'),
+            profile_config.get('interval', 0.01)
         )
-        UDPClientSocket.settimeout(2)
-        try:
-            # Wait for response
-            miio.handle_reply(
-                req[0],
-                miio.msg_decode(UDPClientSocket.recvfrom(miio_len_max)[0]),
-                req[2],
-                states
-            )
-        except socket.timeout:
-            logging.warning("No reply!")
-        UDPClientSocket.settimeout(0.1)
-#    print("Waiting...")
-    try:
-        miio_msgs = miio.msg_decode(UDPClientSocket.recvfrom(miio_len_max)[0])
-        while len(miio_msgs) > 0:
-            miio_msg = miio_msgs.pop()
-            miio.handle_msg(miio_msg, states)
-    except socket.timeout:
-        pass
+    gateways = gateways_init(config, mqtt, loop, profiler)
+    mqtt.loop_start()
+    gateways_start(gateways, loop)
 
-    if (states.get('effect', {}).get('active', False)):
-        handle_effect()
+    resync_interval = config['mqtt'].get('resync', 3600)
+    if resync_interval:
+        loop.call_later(
+            resync_interval, resync, loop, gateways, resync_interval
+        )
 
-    if (time.time() - ts_last_ping) > 200:
-        queue.put(MiioMsg.ping())
-        ts_last_ping = time.time()
-    if (not miio.recent_pong()):
-        mqtt.publish('internal/state', 'OFFLINE')
+    metrics_config = config.get('metrics', {})
+    if metrics_config.get('port'):
+        metrics.serve(
+            loop,
+            metrics_config.get('host', '127.0.0.1'),
+            metrics_config['port']
+        )
+    if metrics_config.get('publish'):
+        loop.call_later(
+            metrics_config['publish'], publish_metrics, loop, mqtt,
+            metrics_config['publish']
+        )
 
-# disconnect
-mqtt.disconnect()
-# stop loop
-mqtt.loop_stop()
+    try:
+        loop.run_forever()
+    finally:
+        for gateway in gateways:
+            gateway.close()
+        # disconnect
+        mqtt.disconnect()
+        # stop loop
+        mqtt.loop_stop()
+
+
+if __name__ == '__main__':
+    main()